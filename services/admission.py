@@ -0,0 +1,135 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Admission control, to shed load before the server gets overloaded.
+"""
+import math
+import time
+import threading
+
+
+class AdmissionController(object):
+    """Limits the number of requests that are processed concurrently.
+
+    acquire() is called before processing a request and returns False if
+    the request should be rejected.  Each admitted request must then be
+    released with its latency.
+
+    Unless `adaptive` is False, the concurrency limit follows the observed
+    latency, in the style of a gradient concurrency limiter.  The lowest
+    latency seen over the last `min_latency_window` seconds is taken as the
+    latency of an unloaded server.  While the average latency stays under
+    `tolerance` times that value the limit is allowed to grow, and past it
+    the limit shrinks proportionally.  The limit always stays between
+    `min_concurrency` and `max_concurrency`.
+    """
+    def __init__(self, name='default', initial_concurrency=20,
+                 min_concurrency=1, max_concurrency=200, tolerance=2.,
+                 smoothing=.2, min_latency_window=30, adaptive=True):
+        self.name = name
+        self.min_concurrency = int(min_concurrency)
+        self.max_concurrency = int(max_concurrency)
+        self.limit = float(min(max(int(initial_concurrency),
+                                   self.min_concurrency),
+                               self.max_concurrency))
+        self.tolerance = float(tolerance)
+        self.smoothing = float(smoothing)
+        self.min_latency_window = float(min_latency_window)
+        self.adaptive = adaptive
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.latency = None
+        self.min_latency = None
+        self._min_latency_reset = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Admits a request if the concurrency limit allows it."""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency=None):
+        """Releases an admitted request, taking its latency into account."""
+        with self._lock:
+            self.in_flight -= 1
+            if latency is not None and self.adaptive:
+                self._update_limit(latency)
+
+    def _update_limit(self, latency):
+        now = time.time()
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        # the unloaded latency is re-estimated regularly, since what the
+        # backends can do changes over time.
+        if self.min_latency is None or now > self._min_latency_reset:
+            self.min_latency = latency
+            self._min_latency_reset = now + self.min_latency_window
+        elif latency < self.min_latency:
+            self.min_latency = latency
+
+        if self.latency <= 0:
+            gradient = 1.
+        else:
+            gradient = self.tolerance * self.min_latency / self.latency
+            gradient = max(.5, min(1., gradient))
+
+        # don't grow the limit when it's not being used
+        if gradient == 1. and self.in_flight * 2 < self.limit:
+            return
+
+        # the square root leaves some room for queuing
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit + self.smoothing * (new_limit - self.limit)
+        self.limit = min(max(limit, self.min_concurrency),
+                         self.max_concurrency)
+
+    def get_state(self):
+        """Returns a mapping describing the current state."""
+        return {'name': self.name,
+                'in_flight': self.in_flight,
+                'limit': int(self.limit),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'latency': self.latency,
+                'min_latency': self.min_latency}
@@ -35,9 +35,9 @@
 # ***** END LICENSE BLOCK *****
 """ Mozilla Authentication using a two-tier system
 """
-import simplejson as json
 import urlparse
 
+from services import jsoncodec
 from services.util import BackendError, get_url
 from services.auth.ldapsql import LDAPAuth
 from services.ldappool import StateConnector
@@ -76,7 +76,7 @@ class MozillaAuth(LDAPAuth):
         - netloc: proxy location
         """
         if data is not None:
-            data = json.dumps(data)
+            data = jsoncodec.dumps(data)
 
         status, headers, body = get_url(url, method, data, headers)
 
@@ -87,7 +87,7 @@ class MozillaAuth(LDAPAuth):
 
         if body:
             try:
-                return json.loads(body)
+                return jsoncodec.loads(body)
             except Exception:
                 self.logger.error("bad json body from sreg (%s): %s" %
                                                         (url, body))
@@ -37,14 +37,17 @@
 """
 Application entry point.
 """
+import inspect
+import os
 import traceback
-import simplejson as json
 import sys
 import signal
-from time import sleep
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import sleep, time
 
 from metlog.client import MetlogClient
-from metlog.decorators.stats import incr_count
 from metlog.holder import CLIENT_HOLDER
 from metlog.senders.logging import StdLibLoggingSender
 
@@ -61,13 +64,23 @@ from webob.exc import (HTTPNotFound, HTTPServiceUnavailable,
                        HTTPException, HTTPMethodNotAllowed)
 
 from services.util import (CatchErrorMiddleware, round_time, BackendError,
-                           create_hash, HTTPJsonServiceUnavailable)
+                           create_hash, HTTPJsonServiceUnavailable,
+                           configure_circuit_breakers, request_deadline,
+                           ErrorLog, get_error_signature)
+from services import jsoncodec
+from services.admission import AdmissionController
 from services.config import Config
+from services.context import request_context
 from services.controllers import StandardController
-from services.events import REQUEST_STARTS, REQUEST_ENDS, APP_ENDS, notify
-from services.metrics import send_services_data, svc_timeit
+from services.health import HealthChecker
+from services.events import (REQUEST_STARTS, REQUEST_ENDS, APP_ENDS, notify,
+                             subscribe, configure_async)
+from services.metrics import (send_services_data, svc_timeit, svc_incr_count,
+                              configure_metrics, flush_metrics,
+                              LatencyHistogram)
 from services.pluginreg import load_and_configure
-from services.user import User
+from services.routing import RouteIndex
+from services.user import make_user
 
 
 class SyncServerApp(object):
@@ -94,9 +107,42 @@ class SyncServerApp(object):
         # debug page, if any
         self.debug_page = self.config.get('global.debug_page')
 
+        # per-route latency page, if any
+        self.metrics_page = self.config.get('global.metrics_page')
+
+        # sampling profiler page, if any
+        self.profile_page = self.config.get('global.profile_page')
+        if self.profile_page is None and self.config.get('profile', False):
+            self.profile_page = '__profile__'
+        # longest profiling run a GET of the page can ask for, in seconds
+        self.profile_max_seconds = float(self.config.get(
+                                    'global.profile_max_seconds', 60))
+
+        # identical errors are only logged once in that many seconds
+        self.error_log = ErrorLog(self.config.get('global.error_log_window',
+                                                  60))
+        subscribe(APP_ENDS, self.error_log.flush, weak=True)
+
+        # time allowed to process a request, if any
+        self.request_timeout = self.config.get('global.request_timeout')
+
         # check if we want to clean when the app ends
         self.sigclean = self.config.get('global.clean_shutdown', True)
 
+        # circuit breakers options for the remote backends, if any
+        breaker_options = self.config.get_section('circuit_breaker')
+        if breaker_options:
+            configure_circuit_breakers(**breaker_options)
+
+        # aggregation and sampling of the metrics sent by the actions
+        configure_metrics(**self.config.get_section('metrics'))
+        subscribe(APP_ENDS, flush_metrics)
+
+        # queue of the asynchronous event subscribers
+        events_options = self.config.get_section('events')
+        if events_options:
+            configure_async(**events_options)
+
         # load the specified plugin modules
         self.modules = dict()
         app_modules = self.config.get('app.modules', [])
@@ -126,12 +172,35 @@ class SyncServerApp(object):
         self.controllers = dict([(name, klass(self)) for name, klass in
                                  controllers.items()])
 
+        # routes served in the reserved lane, tagged with a "priority" extra
+        self.priority_routes = set()
+
+        # user attributes read by the routes, listed in a "user_attrs" extra
+        self.route_user_attrs = {}
+
+        # latency histograms in microseconds, per (controller, action)
+        self.route_latencies = {}
+
+        # (callable, accepts params), per (controller, action)
+        self.actions = {}
+
+        # index of the URL templates, and count of the requests answered
+        # with a 404 or a 405 by the router
+        self.route_index = RouteIndex()
+        self.unrouted_requests = 0
+
         for url in urls:
             if len(url) == 4:
                 verbs, match, controller, action = url
                 extras = {}
             elif len(url) == 5:
                 verbs, match, controller, action, extras = url
+                extras = dict(extras)
+                if extras.pop('priority', False):
+                    self.priority_routes.add((controller, action))
+                user_attrs = extras.pop('user_attrs', None)
+                if user_attrs:
+                    self.route_user_attrs[controller, action] = user_attrs
             else:
                 msg = "Each URL description needs 4 or 5 elements. Got %s" \
                     % str(url)
@@ -140,6 +209,9 @@ class SyncServerApp(object):
             if isinstance(verbs, str):
                 verbs = [verbs]
 
+            if (controller, action) not in self.route_latencies:
+                self.route_latencies[controller, action] = LatencyHistogram()
+
             # wrap action methods w/ metlog decorators
             controller_instance = self.controllers.get(controller)
             if controller_instance is not None:
@@ -149,13 +221,28 @@ class SyncServerApp(object):
                     (not hasattr(controller_instance, wrapped_name))):
                     # add wrapped method
                     wrapped = svc_timeit(method)
-                    wrapped = incr_count(wrapped)
+                    wrapped = svc_incr_count(wrapped)
                     wrapped = send_services_data(wrapped)
                     setattr(controller_instance, wrapped_name, wrapped)
+                if method is not None:
+                    self.actions[controller, action] = (
+                        getattr(controller_instance, wrapped_name),
+                        _accepts_params(method))
+            self.route_index.add(match, verbs, extras.get('requirements'))
             self.mapper.connect(None, match, controller=controller,
                                 action=action, conditions=dict(method=verbs),
                                 **extras)
 
+        # admission control, if any
+        self._load_admission()
+
+        # background health checks of the backends, if any
+        health_options = self.config.get_section('health')
+        if health_options.pop('enabled', False):
+            self.health = HealthChecker(**health_options)
+        else:
+            self.health = None
+
         # loads host-specific configuration
         self._host_configs = {}
 
@@ -168,6 +255,9 @@ class SyncServerApp(object):
 
         # hooking callbacks when the app shuts down
         self.killing = self.shutting = False
+        self.drained = False
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
         self.graceful_shutdown_interval = self.config.get(
                                       'global.graceful_shutdown_interval', 1.)
         self.hard_shutdown_interval = self.config.get(
@@ -176,23 +266,155 @@ class SyncServerApp(object):
             signal.signal(signal.SIGTERM, self._sigterm)
             signal.signal(signal.SIGINT, self._sigterm)
 
-    def _sigterm(self, signal, frame):
-        self.shutting = True
+    def _sigterm(self, signum, frame):
+        # once drained, the signal is sent again to exit from here
+        if self.drained:
+            sys.exit(0)
+        if self.killing:
+            return
+
+        # the handler may have interrupted a request in flight, so the
+        # draining can't wait here: it's done in a thread, or a greenlet
+        # when threading is monkey-patched by gevent
+        self.shutting = self.killing = True
+        self._drainer = threading.Thread(target=self._drain_and_exit,
+                                         args=(signum,))
+        self._drainer.daemon = True
+        self._drainer.start()
+
+    def _drain_and_exit(self, signum):
+        self.drain()
+        self.drained = True
+        self._exit(signum)
+
+    def _exit(self, signum):
+        """Exits the process from the signal handler, in the main thread."""
+        os.kill(os.getpid(), signum)
+
+    def drain(self):
+        """Stops serving and waits for the requests being processed.
+
+        The heartbeat fails and new requests get a 503 right away, then the
+        app waits until no request is in flight, for at most the graceful
+        and hard shutdown intervals.  APP_ENDS is notified at the end, so
+        the backends can close their connection pools.
+        """
+        self.shutting = self.killing = True
+        deadline = time() + (self.graceful_shutdown_interval +
+                             self.hard_shutdown_interval)
+        while self.in_flight > 0 and time() < deadline:
+            sleep(0.05)
 
-        # wait for a bit
-        sleep(self.graceful_shutdown_interval)
+        # now we can notify the end -- so pending stuff can be cleaned up
+        notify(APP_ENDS)
 
-        # no more queries
-        self.killing = True
+    def _load_admission(self):
+        """Creates the admission controllers from the config.
 
-        # wait for a bit
-        sleep(self.hard_shutdown_interval)
+        "admission" is the controller used for all user requests, and
+        "controller_admission" maps app controllers to their own admission
+        controller.  Options prefixed by a controller name, like
+        "storage.max_concurrency", create a specific admission controller
+        for it.
 
-        # now we can notify the end -- so pending stuff can be cleaned up
-        notify(APP_ENDS)
+        "reserved_lane" is a fixed amount of concurrency reserved for the
+        debug, metrics and profile pages and for the priority routes, which
+        never go through the other admission controllers.  For this to hold
+        all the way down, the worker must accept more connections than the
+        limit of user requests.
 
-        # bye-bye
-        sys.exit(0)
+        The heartbeat page goes through no admission controller at all, so
+        a load balancer never sees a healthy node shed its health checks.
+        """
+        self.admission = self.reserved_lane = None
+        self.controller_admission = {}
+        options = self.config.get_section('admission')
+        if not options.pop('enabled', False):
+            return
+        self.admission_retry_after = options.pop('retry_after', 5)
+        reserved = options.pop('reserved_concurrency', 10)
+        self.reserved_lane = AdmissionController('reserved', reserved,
+                                                 max_concurrency=reserved,
+                                                 adaptive=False)
+
+        per_controller = defaultdict(dict)
+        for key, value in options.items():
+            if '.' in key:
+                del options[key]
+                controller, key = key.split('.', 1)
+                per_controller[controller][key] = value
+
+        self.admission = AdmissionController(**options)
+        for name, opts in per_controller.items():
+            self.controller_admission[name] = AdmissionController(name, **opts)
+
+    def get_admission_info(self):
+        """Returns the state of all admission controllers."""
+        if self.admission is None:
+            return []
+        controllers = [self.admission, self.reserved_lane]
+        controllers.extend(self.controller_admission.values())
+        return [controller.get_state() for controller in controllers]
+
+    def _get_lanes(self, match=None):
+        """Returns the admission controllers a request must go through.
+
+        Requests with no match are the internal pages.
+        """
+        if self.admission is None:
+            return []
+        if match is None:
+            return [self.reserved_lane]
+        if (match['controller'], match['action']) in self.priority_routes:
+            return [self.reserved_lane]
+        lanes = [self.admission]
+        if match['controller'] in self.controller_admission:
+            lanes.append(self.controller_admission[match['controller']])
+        return lanes
+
+    @contextmanager
+    def _admitted(self, lanes):
+        """Context manager admitting a request through all lanes, or
+        raising a 503 if any of them is full.
+        """
+        for index, lane in enumerate(lanes):
+            if not lane.acquire():
+                for acquired in lanes[:index]:
+                    acquired.release()
+                raise HTTPServiceUnavailable(
+                                    retry_after=self.admission_retry_after)
+        start = time()
+        try:
+            yield
+        finally:
+            latency = time() - start
+            for lane in lanes:
+                lane.release(latency)
+
+    def get_route_latencies(self):
+        """Returns the latency summaries of all routes, in milliseconds."""
+        routes = []
+        latencies = sorted(self.route_latencies.items())
+        for (controller, action), histogram in latencies:
+            summary = histogram.get_summary()
+            for key, value in summary.items():
+                if key != 'count':
+                    summary[key] = value / 1000.
+            summary['controller'] = controller
+            summary['action'] = action
+            routes.append(summary)
+        return routes
+
+    def reset_route_latencies(self):
+        """Empties the latency histograms of all routes."""
+        for histogram in self.route_latencies.values():
+            histogram.reset()
+
+    def _record_latency(self, match, latency):
+        histogram = self.route_latencies.get((match['controller'],
+                                              match['action']))
+        if histogram is not None:
+            histogram.record(latency * 1000000)
 
     def _before_call(self, request):
         return {}
@@ -216,6 +438,12 @@ class SyncServerApp(object):
     def _heartbeat(self, request):
         return self.standard_controller._heartbeat(request)
 
+    def _metrics(self, request):
+        return self.standard_controller._metrics(request)
+
+    def _profile(self, request):
+        return self.standard_controller._profile(request)
+
     # events fired when a request is handled
     def _notified(func):
         def __notified(self, request):
@@ -243,10 +471,20 @@ class SyncServerApp(object):
     @_notified
     def __call__(self, request):
         """Entry point for the WSGI app."""
-        # the app is being killed, no more requests please
-        if self.killing:
-            raise HTTPServiceUnavailable()
+        # counted first, so that draining never misses a request
+        with self._in_flight_lock:
+            self.in_flight += 1
+        try:
+            # the app is being killed, no more requests please
+            if self.killing:
+                raise HTTPServiceUnavailable()
+            return self._handle_request(request)
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
 
+    def _handle_request(self, request):
+        """Processes a request admitted by __call__."""
         request.server_time = round_time()
 
         # gets request-specific config
@@ -256,7 +494,9 @@ class SyncServerApp(object):
         before_headers = self._before_call(request)
 
         try:
-            response = self._dispatch_request(request)
+            with request_context(request=request):
+                with request_deadline(self.request_timeout):
+                    response = self._dispatch_request(request)
         except HTTPException, response:
             # set before-call headers on all responses
             response.headers.update(before_headers)
@@ -285,22 +525,45 @@ class SyncServerApp(object):
             if self.shutting:
                 raise HTTPServiceUnavailable()
 
-            # otherwise we do call the heartbeat page
+            # otherwise we do call the heartbeat page, which is cheap and
+            # is never shed
             if (self.heartbeat_page is not None and
                 request.method in ('HEAD', 'GET')):
                 return self._heartbeat(request)
 
         # the debug page is called
         if self.debug_page is not None and url == '/%s' % self.debug_page:
-            return self._debug(request)
+            with self._admitted(self._get_lanes()):
+                return self._debug(request)
+
+        # the metrics page is called
+        if self.metrics_page is not None and url == '/%s' % self.metrics_page:
+            with self._admitted(self._get_lanes()):
+                return self._metrics(request)
+
+        # the profiler page is called
+        if self.profile_page is not None and url == '/%s' % self.profile_page:
+            with self._admitted(self._get_lanes()):
+                return self._profile(request)
+
+        # paths that can't match any URL are rejected before routing
+        path = request.path_info
+        if not self.route_index.is_routable(path):
+            with self._in_flight_lock:
+                self.unrouted_requests += 1
+            return HTTPNotFound()
 
         # the request must be going to a controller method
         match = self.mapper.routematch(environ=request.environ)
 
         if match is None:
+            with self._in_flight_lock:
+                self.unrouted_requests += 1
             # Check whether there is a match on just the path.
             # If not then it's a 404; if so then it's a 405.
-            match = self.mapper.routematch(url=request.path_info)
+            if self.route_index.get_methods(path) is not None:
+                return HTTPMethodNotAllowed()
+            match = self.mapper.routematch(url=path)
             if match is None:
                 return HTTPNotFound()
             else:
@@ -308,6 +571,16 @@ class SyncServerApp(object):
 
         match, __ = match
 
+        # shedding load if we are processing too many requests already
+        with self._admitted(self._get_lanes(match)):
+            start = time()
+            try:
+                return self._dispatch_request_with_auth(request, match)
+            finally:
+                self._record_latency(match, time() - start)
+
+    def _dispatch_request_with_auth(self, request, match):
+        """Dispatch the request, wrapped in the auth checks if any."""
         # if auth is enabled, wrap it around the call to the controller
         if self.auth is None:
             return self._dispatch_request_with_match(request, match)
@@ -324,9 +597,15 @@ class SyncServerApp(object):
 
     def _dispatch_request_with_match(self, request, match):
         """Dispatch a request according to a URL routing match."""
-        function = self._get_function(match['controller'], match['action'])
-        if function is None:
-            raise HTTPNotFound('Unknown URL %r' % request.path_info)
+        try:
+            function, accepts_params = self.actions[match['controller'],
+                                                     match['action']]
+        except KeyError:
+            function = self._get_function(match['controller'],
+                                          match['action'])
+            if function is None:
+                raise HTTPNotFound('Unknown URL %r' % request.path_info)
+            accepts_params = True
 
         # extracting all the info from the headers and the url
         request.sync_info = match
@@ -334,27 +613,42 @@ class SyncServerApp(object):
         # creating a user object to be passed around the request, if one hasn't
         # already been set
         if not hasattr(request, 'user'):
-            request.user = User()
+            request.user = make_user(getattr(self.auth, 'backend', None))
             if 'username' in request.sync_info:
                 request.user['username'] = request.sync_info['username']
             if 'user_id' in request.sync_info:
                 request.user['userid'] = request.sync_info['user_id']
 
-        params = self._get_params(request)
+        # the user attributes the action reads come in a single query
+        user_attrs = self.route_user_attrs.get((match['controller'],
+                                                match['action']))
+        if user_attrs and hasattr(request.user, 'prefetch'):
+            request.user.prefetch(*user_attrs)
+
         try:
-            result = function(request, **params)
+            if accepts_params:
+                result = function(request, **self._get_params(request))
+            else:
+                result = function(request)
         except BackendError as err:
             err.request = request
-            err_info = str(err)
-            err_trace = traceback.format_exc()
-            extra_info = ['%s: %s' % (key, value)
-                          for key, value in self.get_infos(request).items()]
-            extra_info = '\n'.join(extra_info)
-            error_log = '%s\n%s\n%s' % (err_info, err_trace, extra_info)
-            hash = create_hash(error_log)
-            self.logger.error(hash)
-            self.logger.error(error_log)
-            msg = json.dumps("application error: crash id %s" % hash)
+            exc_type, exc_val, exc_tb = sys.exc_info()
+
+            def _format_error():
+                err_info = str(err)
+                err_trace = ''.join(traceback.format_exception(
+                    exc_type, exc_val, exc_tb))
+                extra_info = ['%s: %s' % (key, value) for key, value
+                              in self.get_infos(request).items()]
+                extra_info = '\n'.join(extra_info)
+                return '%s\n%s\n%s' % (err_info, err_trace, extra_info)
+
+            # identical errors are logged once per window, but each request
+            # gets its own crash id
+            signature = get_error_signature(exc_type, exc_tb)
+            hash = create_hash(repr(signature))
+            self.error_log.log(self.logger, signature, hash, _format_error)
+            msg = jsoncodec.dumps("application error: crash id %s" % hash)
             if err.retry_after is not None:
                 if err.retry_after == 0:
                     retry_after = None
@@ -407,6 +701,18 @@ class SyncServerApp(object):
         return fn
 
 
+def _accepts_params(method):
+    """Tells if an action takes parameters besides the request."""
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(method)
+    except TypeError:
+        # not a Python function
+        return True
+    if inspect.ismethod(method):
+        args = args[1:]
+    return keywords is not None or len(args) > 1
+
+
 def set_app(urls, controllers, klass=SyncServerApp, auth_class=None,
             wrapper=None):
     """make_app factory."""
@@ -420,15 +726,6 @@ def set_app(urls, controllers, klass=SyncServerApp, auth_class=None,
             app = TransLogger(app, logger_name='syncserver',
                               setup_console_handler=True)
 
-        if params.get('profile', False):
-            from repoze.profile.profiler import AccumulatingProfileMiddleware
-            app = AccumulatingProfileMiddleware(app,
-                                          log_filename='profile.log',
-                                          cachegrind_filename='cachegrind.out',
-                                          discard_first_request=True,
-                                          flush_at_shutdown=True,
-                                          path='/__profile__')
-
         if params.get('client_debug', False):
             # errors are displayed in the user client
             app = ErrorMiddleware(app, debug=True,
@@ -436,7 +733,9 @@ def set_app(urls, controllers, klass=SyncServerApp, auth_class=None,
         else:
             # errors are logged and a 500 is returned with an empty body
             # to avoid any security whole
-            app = CatchErrorMiddleware(app, logger_name='syncserver')
+            error_window = params.get('global.error_log_window', 60)
+            app = CatchErrorMiddleware(app, logger_name='syncserver',
+                                       error_window=error_window)
 
         if wrapper is not None:
             app = wrapper(app, config=params)
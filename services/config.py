@@ -42,6 +42,7 @@ import os
 from copy import copy
 from ConfigParser import RawConfigParser
 from services.exceptions import EnvironmentNotFoundError
+from services.memory import register_cache
 
 
 _IS_NUMBER = re.compile('^-?[0-9].*')
@@ -181,6 +182,8 @@ class Config(dict):
         if cfgfile is not None:
             self.load_from_file(cfgfile)
         self._merge_cache = dict()
+        register_cache('config.merge_cache', self,
+                       lambda config: len(config._merge_cache))
 
     def load_config(self, cfgdict):
         """
@@ -0,0 +1,87 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Per-request context, shared by the code serving a request.
+
+Each greenlet (or thread, without gevent) has its own stack of contexts.
+A context is a dict pushed with request_context() and popped when the
+block exits, so nested contexts never clobber the outer ones and
+concurrent requests on the same worker never see each other's data.
+"""
+from contextlib import contextmanager
+
+# The greenlet is looked up directly so this works whether or not
+# gevent monkey-patching happened before this module was imported.
+try:
+    from greenlet import getcurrent as _get_ident
+except ImportError:
+    from thread import get_ident as _get_ident
+
+
+_STACKS = {}
+
+
+@contextmanager
+def request_context(**values):
+    """Pushes a new context holding `values` for the duration of the block.
+
+    Returns the context dict, which can be updated within the block.
+    """
+    ident = _get_ident()
+    stack = _STACKS.setdefault(ident, [])
+    context = dict(values)
+    stack.append(context)
+    try:
+        yield context
+    finally:
+        stack.pop()
+        if not stack:
+            del _STACKS[ident]
+
+
+def get_context():
+    """Returns the innermost context, or None outside of any context."""
+    stack = _STACKS.get(_get_ident())
+    if not stack:
+        return None
+    return stack[-1]
+
+
+def get_context_value(key, default=None):
+    """Returns the value of `key` in the innermost context defining it."""
+    for context in reversed(_STACKS.get(_get_ident(), ())):
+        if key in context:
+            return context[key]
+    return default
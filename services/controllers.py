@@ -37,11 +37,18 @@
 Application entry point.
 """
 import re
+import time
 import pprint
 import StringIO
 
-from services.formatters import html_response, text_response
+from webob.exc import HTTPServiceUnavailable, HTTPBadRequest
 
+from services.formatters import html_response, text_response, json_response
+from services.profiler import get_profiler
+from services.util import HTTPJsonServiceUnavailable
+
+
+_PROMETHEUS_QUANTILES = ((50, '0.5'), (90, '0.9'), (99, '0.99'))
 
 _DEBUG_TMPL = """
 <html>
@@ -57,6 +64,10 @@ _DEBUG_TMPL = """
   <pre>
   %(extra)s
   </pre>
+  <h1>Admission control</h1>
+  <pre>
+%(admission)s
+  </pre>
  </body>
 </html>"""
 
@@ -68,6 +79,8 @@ class StandardController(object):
 
     - a heartbeat page
     - a debug page
+    - a per-route latency page
+    - a sampling profiler page
     """
     def __init__(self, app):
         self.app = app
@@ -124,6 +137,13 @@ class StandardController(object):
 
         # filtering extra info
         data['extra'] = sqluri.sub(replacer, extra)
+
+        # admission control state
+        admission = getattr(self.app, 'get_admission_info', list)()
+        if admission:
+            data['admission'] = pprint.pformat(admission)
+        else:
+            data['admission'] = 'None.'
         return html_response(res % data)
 
     #
@@ -144,7 +164,121 @@ class StandardController(object):
 
         It is enabled by default at __heartbeat__ but does not perform
         any test on the infra unless _check_server is overriden.
+
+        If the app has health checks enabled, the last known status of the
+        backends is also used, and the "details" query parameter returns it
+        as a JSON mapping with per-backend latencies.
         """
         # calls the check if any - this will raise a 503 if anything's wrong
         self._check_server(request)
+
+        health = getattr(self.app, 'health', None)
+        if health is None:
+            return text_response('')
+
+        status = health.get_status()
+        if 'details' in request.GET:
+            if not status['ok']:
+                raise HTTPJsonServiceUnavailable(status)
+            return json_response(status)
+        if not status['ok']:
+            raise HTTPServiceUnavailable()
         return text_response('')
+
+    #
+    # Latency page
+    #
+    def _metrics(self, request):
+        """Returns the latency percentiles of each route, in milliseconds.
+
+        The page returns a JSON list by default, and the Prometheus text
+        format (in seconds) with the "format=prometheus" query parameter,
+        along with the count of the requests that matched no route.  A POST
+        resets the histograms.
+
+        It is disabled by default.
+        """
+        if request.method == 'POST':
+            self.app.reset_route_latencies()
+            return text_response('')
+
+        routes = self.app.get_route_latencies()
+        if request.GET.get('format') != 'prometheus':
+            return json_response(routes)
+
+        name = 'services_request_latency_seconds'
+        lines = ['# HELP %s Latency of the requests, per route.' % name,
+                 '# TYPE %s summary' % name]
+        maxima = ['# HELP %s_max Slowest request, per route.' % name,
+                  '# TYPE %s_max gauge' % name]
+        for route in routes:
+            labels = 'controller="%(controller)s",action="%(action)s"' % route
+            for percentile, quantile in _PROMETHEUS_QUANTILES:
+                value = route['p%d' % percentile] / 1000.
+                lines.append('%s{%s,quantile="%s"} %r' % (name, labels,
+                                                         quantile, value))
+            lines.append('%s_sum{%s} %r' % (name, labels,
+                                            route['sum'] / 1000.))
+            lines.append('%s_count{%s} %d' % (name, labels, route['count']))
+            maxima.append('%s_max{%s} %r' % (name, labels,
+                                             route['max'] / 1000.))
+
+        name = 'services_unrouted_requests_total'
+        unrouted = getattr(self.app, 'unrouted_requests', 0)
+        counters = ['# HELP %s Requests answered with a 404 or a 405 by the '
+                    'router.' % name,
+                    '# TYPE %s counter' % name,
+                    '%s %d' % (name, unrouted)]
+        return text_response('\n'.join(lines + maxima + counters) + '\n')
+
+    #
+    # Profiler page
+    #
+    def _profile(self, request):
+        """Drives the sampling profiler of the process.
+
+        A GET returns the samples taken so far, in the collapsed stacks
+        format of flamegraph.pl.  With the "seconds" query parameter, the
+        samples are reset and taken for that many seconds first, at most
+        "global.profile_max_seconds" (60 by default).  A POST
+        with an "action" parameter of "start", "stop" or "reset" drives the
+        profiler.
+
+        The profiler can only be started from the main thread, which serves
+        all the requests under gevent but not in a threaded server: a 503
+        is returned there.
+
+        It is disabled by default.
+        """
+        profiler = get_profiler()
+        if request.method == 'POST':
+            action = request.params.get('action')
+            if action not in ('start', 'stop', 'reset'):
+                raise HTTPBadRequest('Unknown action %r' % action)
+            if action == 'start':
+                self._start_profiler(profiler)
+            else:
+                getattr(profiler, action)()
+            return text_response('')
+
+        if 'seconds' in request.GET:
+            try:
+                seconds = float(request.GET['seconds'])
+            except ValueError:
+                raise HTTPBadRequest('Invalid number of seconds')
+            if not seconds > 0:
+                raise HTTPBadRequest('Invalid number of seconds')
+            seconds = min(seconds, self.app.profile_max_seconds)
+            profiler.reset()
+            self._start_profiler(profiler)
+            try:
+                time.sleep(seconds)
+            finally:
+                profiler.stop()
+        return text_response(profiler.get_collapsed_stacks())
+
+    def _start_profiler(self, profiler):
+        try:
+            profiler.start()
+        except ValueError, e:
+            raise HTTPServiceUnavailable(str(e))
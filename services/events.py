@@ -35,26 +35,303 @@
 # ***** END LICENSE BLOCK *****
 """
 Event registry
+
+The subscribers of each event are kept in a tuple which is replaced, never
+modified, when a subscriber is added or removed.  notify() just loops over
+the current tuple, so it takes no lock and is not disturbed by subscribers
+added or removed while it runs.
+
+Subscribers registered as asynchronous are not called by notify(): their
+calls are queued and made by a background worker, so a slow subscriber
+does not slow down the code firing the event.
+
+Subscribers registered as weak are bound methods whose object is not kept
+alive by the registry: they are unsubscribed once their object went away.
+The garbage collector can run while the lock is held, so the weakref
+callback only queues the dead subscriber, and it is removed by the next
+subscribe(), unsubscribe() or notify().
 """
-from collections import defaultdict
+import os
+import Queue
+import threading
+import time
+import weakref
+
+from metlog.holder import CLIENT_HOLDER
+
+
+_events = {}
+_lock = threading.Lock()
+_dead = []
+_timing_callback = None
+
+
+class AsyncDispatcher(object):
+    """Calls the asynchronous subscribers from a background worker.
+
+    At most `max_size` calls are queued.  When the queue is full, the new
+    call is dropped if `drop_policy` is "newest", or the oldest queued call
+    is dropped to make room if it is "oldest".  The drops are counted per
+    event in `dropped`.
+
+    The worker is a thread (a greenlet under gevent), started on the first
+    call in the process serving the requests, so it survives the fork, and
+    stopped by stop().
+    """
+    def __init__(self, max_size=1000, drop_policy='newest'):
+        if drop_policy not in ('newest', 'oldest'):
+            raise ValueError('Unknown drop policy %r' % drop_policy)
+        self.drop_policy = drop_policy
+        self.dropped = {}
+        self._queue = Queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = None
+        self._stopped = False
+
+    def put(self, event, func, args, kw):
+        """Queues a call of func(*args, **kw), for the given event."""
+        if self._pid != os.getpid():
+            self._start()
+        call = (event, func, args, kw)
+        try:
+            self._queue.put_nowait(call)
+            return
+        except Queue.Full:
+            if self.drop_policy == 'newest':
+                self._drop(call)
+                return
+        try:
+            self._drop(self._queue.get_nowait())
+            self._queue.task_done()
+        except Queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(call)
+        except Queue.Full:
+            self._drop(call)
+
+    def _drop(self, call):
+        event = call[0]
+        self.dropped[event] = self.dropped.get(event, 0) + 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            call = self._queue.get()
+            if self._stopped:
+                self._queue.task_done()
+                return
+            event, func, args, kw = call
+            try:
+                func(*args, **kw)
+            except Exception:
+                CLIENT_HOLDER.default_client.exception(
+                                    'Subscriber of %r failed' % event)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout=5):
+        """Waits for the queued calls to be made, for at most `timeout`
+        seconds.  Returns True if the queue was emptied.
+        """
+        if self._pid != os.getpid():
+            return True
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        """Stops the worker once it is done with the current call.
+
+        The calls still queued are not made.
+        """
+        self._stopped = True
+        if self._pid != os.getpid():
+            return
+        # wakes the worker up if it waits for a call
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+
+_dispatcher = AsyncDispatcher()
+
+
+class _AsyncSubscriber(object):
+    """Queues the calls to a subscriber.  Equal to the subscriber, so that
+    it can be unsubscribed like any other."""
+    def __init__(self, event, func):
+        self.event = event
+        self.func = func
+
+    def __call__(self, *args, **kw):
+        _dispatcher.put(self.event, self.func, args, kw)
+
+    def __eq__(self, other):
+        if isinstance(other, _AsyncSubscriber):
+            other = other.func
+        return self.func == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.func)
+
+    def __repr__(self):
+        return '<async %r>' % (self.func,)
 
 
-_events = defaultdict(list)
+class _WeakSubscriber(object):
+    """Calls a bound method without keeping its object alive.  Equal to
+    the bound method, so that it can be unsubscribed like any other."""
+    def __init__(self, event, method):
+        self.event = event
+        self.func = method.im_func
+        self.ref = weakref.ref(method.im_self, self._collected)
+        self._hash = hash((self.func, id(method.im_self)))
 
+    def _collected(self, ref):
+        # no lock here, see the module docstring
+        _dead.append(self)
 
-def subscribe(event, func):
-    if func not in _events[event]:
-        _events[event].append(func)
+    def __call__(self, *args, **kw):
+        obj = self.ref()
+        if obj is not None:
+            return self.func(obj, *args, **kw)
+
+    def __eq__(self, other):
+        if isinstance(other, _WeakSubscriber):
+            return self is other or (self.func is other.func and
+                                     self.ref() is other.ref() is not None)
+        return (getattr(other, 'im_func', None) is self.func and
+                getattr(other, 'im_self', None) is self.ref() is not None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return '<weak %r of %r>' % (self.func, self.ref())
+
+
+def subscribe(event, func, asynchronous=False, weak=False):
+    """Registers `func` to be called when `event` is notified.
+
+    If `asynchronous` is True, the calls are made by a background worker,
+    after notify() returned.  APP_ENDS subscribers are always called
+    synchronously.
+
+    If `weak` is True, `func` must be a bound method: its object is not
+    kept alive by the subscription, which is removed when the object is
+    garbage collected.
+    """
+    if weak:
+        func = _WeakSubscriber(event, func)
+    if asynchronous and event != APP_ENDS:
+        func = _AsyncSubscriber(event, func)
+    with _lock:
+        _prune()
+        funcs = _events.get(event, ())
+        if func not in funcs:
+            _events[event] = funcs + (func,)
+
+
+def _remove(event, func):
+    # must be called with the lock held
+    funcs = _events.get(event, ())
+    if func in funcs:
+        funcs = tuple([f for f in funcs if f != func])
+        if funcs:
+            _events[event] = funcs
+        else:
+            del _events[event]
+
+
+def _prune():
+    # must be called with the lock held
+    while _dead:
+        subscriber = _dead.pop()
+        _remove(subscriber.event, subscriber)
 
 
 def notify(event, *args, **kw):
-    for func in _events[event]:
-        func(*args, **kw)
+    if _dead:
+        with _lock:
+            _prune()
+    funcs = _events.get(event)
+    if not funcs:
+        return
+    if _timing_callback is None:
+        for func in funcs:
+            func(*args, **kw)
+    else:
+        _timed_notify(event, funcs, args, kw)
+
+
+def _timed_notify(event, funcs, args, kw):
+    for func in funcs:
+        start = time.time()
+        try:
+            func(*args, **kw)
+        finally:
+            _timing_callback(event, func, time.time() - start)
 
 
 def unsubscribe(event, func):
-    if func in _events[event]:
-        _events[event].remove(func)
+    with _lock:
+        _prune()
+        _remove(event, func)
+
+
+def configure_async(max_size=1000, drop_policy='newest'):
+    """Sets up the queue of the asynchronous subscribers.
+
+    The calls queued so far are flushed first, and the previous worker
+    is stopped.
+    """
+    global _dispatcher
+    _dispatcher.flush()
+    _dispatcher.stop()
+    _dispatcher = AsyncDispatcher(max_size, drop_policy)
+
+
+def flush_async(timeout=5):
+    """Waits for the calls of the asynchronous subscribers to be made.
+
+    It is done when APP_ENDS is notified, before the other subscribers.
+    """
+    return _dispatcher.flush(timeout)
+
+
+def get_async_dropped():
+    """Returns the number of dropped asynchronous calls, per event."""
+    return dict(_dispatcher.dropped)
+
+
+def set_timing_callback(callback):
+    """Times the subscribers, to find the slow ones.
+
+    After each subscriber call, callback(event, func, duration) is called
+    with the duration in seconds.  Use None to stop timing.
+    """
+    global _timing_callback
+    _timing_callback = callback
 
 
 # called when a request enters the application.
@@ -68,3 +345,5 @@ REQUEST_ENDS = 'server-core.request-ends'
 # Called when the app shuts down (SIGTERM/SIGINT)
 # the callable is called with no option
 APP_ENDS = 'server-code.app.ends'
+
+subscribe(APP_ENDS, flush_async)
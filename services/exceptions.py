@@ -77,6 +77,11 @@ class BackendTimeoutError(BackendError):
     pass
 
 
+class CircuitOpenError(BackendError):
+    """Raised without calling the backend when its circuit breaker is open."""
+    pass
+
+
 class MaxConnectionReachedError(Exception):
     """Raised by ldappool"""
     pass
@@ -43,18 +43,29 @@
 # Support functions for templating and l10n should go in here as well
 
 from webob import Response
-import simplejson as json
 import struct
 
+from services import jsoncodec
+
 
 def text_response(data, **kw):
     """Returns Response containing a plain text"""
     return Response(str(data), content_type='text/plain', **kw)
 
 
+# Number of items above which convert_response streams the output.
+#
+# A streamed body is produced by the WSGI server after the application
+# returned, so outside of the request context, the request deadline, the
+# metlog data and the error handling of the request.  This is why only the
+# encoding of items already computed is streamed by default, and iterators
+# are consumed before returning unless the caller asks otherwise.
+STREAMING_THRESHOLD = 1000
+
+
 def json_response(data, **kw):
     """Returns Response containing a json string"""
-    return Response(json.dumps(data, use_decimal=True),
+    return Response(jsoncodec.dumps(data),
                                content_type='application/json', **kw)
 
 
@@ -63,31 +74,90 @@ def html_response(data, **kw):
     return Response(str(data), content_type='text/html', **kw)
 
 
+def _newline(line):
+    line = jsoncodec.dumps(line).replace('\n', '\u000a')
+    return '%s\n' % line
+
+
+def _whoisi(line):
+    line = jsoncodec.dumps(line)
+    size = struct.pack('!I', len(line))
+    return '%s%s' % (size, line)
+
+
 def newlines_response(lines, **kw):
     """Returns a Response object containing a newlines output."""
-    def _convert(line):
-        line = json.dumps(line, use_decimal=True).replace('\n', '\u000a')
-        return '%s\n' % line
-
-    data = [_convert(line) for line in lines]
+    data = [_newline(line) for line in lines]
     return Response(''.join(data), content_type='application/newlines', **kw)
 
 
 def whoisi_response(lines, **kw):
     """Returns a Response object containing a whoisi output."""
-
-    def _convert(line):
-        line = json.dumps(line, use_decimal=True)
-        size = struct.pack('!I', len(line))
-        return '%s%s' % (size, line)
-
-    data = [_convert(line) for line in lines]
+    data = [_whoisi(line) for line in lines]
     return Response(''.join(data), content_type='application/whoisi', **kw)
 
 
-def convert_response(request, lines, **kw):
+def _batched(chunks, batch_size):
+    """Joins the chunks by groups of batch_size."""
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def _json_chunks(data):
+    if not isinstance(data, (list, tuple)) and not hasattr(data, 'next'):
+        yield jsoncodec.dumps(data)
+        return
+    # same output as jsoncodec.dumps, one item at a time
+    separator = '['
+    for item in data:
+        yield separator + jsoncodec.dumps(item)
+        separator = ', '
+    if separator == '[':
+        yield '[]'
+    else:
+        yield ']'
+
+
+def stream_json_response(data, batch_size=100, **kw):
+    """Returns a Response object streaming a json string.
+
+    Lists, tuples and iterators are encoded one item at a time, and sent by
+    batches of batch_size items.
+    """
+    app_iter = _batched(_json_chunks(data), batch_size)
+    return Response(app_iter=app_iter, content_type='application/json', **kw)
+
+
+def stream_newlines_response(lines, batch_size=100, **kw):
+    """Returns a Response object streaming a newlines output, by batches of
+    batch_size lines."""
+    app_iter = _batched((_newline(line) for line in lines), batch_size)
+    return Response(app_iter=app_iter, content_type='application/newlines',
+                    **kw)
+
+
+def stream_whoisi_response(lines, batch_size=100, **kw):
+    """Returns a Response object streaming a whoisi output, by batches of
+    batch_size lines."""
+    app_iter = _batched((_whoisi(line) for line in lines), batch_size)
+    return Response(app_iter=app_iter, content_type='application/whoisi',
+                    **kw)
+
+
+def convert_response(request, lines, stream=False, **kw):
     """Returns the response in the appropriate format, depending on the accept
-    request."""
+    request.
+
+    The response is streamed if there are more than STREAMING_THRESHOLD
+    lines.  An iterator is consumed first, unless `stream` is True: it is
+    then streamed as it goes, after the request is processed (see
+    STREAMING_THRESHOLD)."""
     try:
         content_type = request.accept.best_match(('application/json',
                                                   'application/newlines',
@@ -96,11 +166,24 @@ def convert_response(request, lines, **kw):
         # Bad input from the client could trigger either of these errors.
         content_type = None
 
+    if stream:
+        streaming = True
+    else:
+        if not hasattr(lines, '__len__'):
+            lines = list(lines)
+        streaming = len(lines) > STREAMING_THRESHOLD
+
     if content_type == 'application/newlines':
+        if streaming:
+            return stream_newlines_response(lines, **kw)
         return newlines_response(lines, **kw)
     elif content_type == 'application/whoisi':
+        if streaming:
+            return stream_whoisi_response(lines, **kw)
         return whoisi_response(lines, **kw)
 
     # default response format is json
     # TODO: technically we should return "406 Not Acceptable" here.
+    if streaming:
+        return stream_json_response(lines, **kw)
     return json_response(lines, **kw)
@@ -45,6 +45,7 @@ import sys
 import time
 import thread
 import signal
+import weakref
 import traceback
 
 import greenlet
@@ -54,6 +55,10 @@ from gunicorn.workers.ggevent import GeventWorker
 
 from metlog.holder import CLIENT_HOLDER
 
+from services.memory import MemoryProfiler
+from services.metrics import LatencyHistogram
+from services.util import request_deadline
+
 # Take references to un-monkey-patched versions of stuff we need.
 # Monkey-patching will have already been done by the time we come to
 # use these functions at runtime.
@@ -67,10 +72,99 @@ _real_get_ident = thread.get_ident
 MAX_BLOCKING_TIME = float(os.environ.get("GEVENT_MAX_BLOCKING_TIME", 0.1))
 
 
+# The interval between two summaries of the event-loop blocking, and the
+# number of distinct stacks reported in each summary.
+BLOCKING_SUMMARY_INTERVAL = float(os.environ.get(
+                                "GEVENT_BLOCKING_SUMMARY_INTERVAL", 60))
+BLOCKING_SUMMARY_SIZE = int(os.environ.get("GEVENT_BLOCKING_SUMMARY_SIZE", 5))
+
+# The amount of time after which a blocking still in progress is logged
+# right away, without waiting for the loop to unblock or for the summary.
+MAX_BLOCKING_EPISODE = float(os.environ.get("GEVENT_MAX_BLOCKING_EPISODE", 1))
+
+
 # The filename for dumping memory usage data.
 MEMORY_DUMP_FILE = os.environ.get("MOZSVC_MEMORY_DUMP_FILE",
                                   "/tmp/mozsvc-memdump")
 
+# Whether to dump the whole heap instead of the growth of the object counts.
+MEMORY_DUMP_FULL = os.environ.get("MOZSVC_MEMORY_DUMP_FULL", "") != ""
+
+
+def _get_frame_greenlet(frame):
+    """Returns the greenlet running the stack of `frame`, if known.
+
+    The outermost frame of a greenlet is its run() method, so the greenlet
+    is found as the "self" of that frame.
+    """
+    while frame.f_back is not None:
+        frame = frame.f_back
+    owner = frame.f_locals.get('self')
+    if isinstance(owner, greenlet.greenlet):
+        return owner
+    return None
+
+
+class BlockingStats(object):
+    """Aggregated statistics about the blocking of the event-loop.
+
+    The durations go in a histogram, the stacks are deduped by a hash of
+    their frames and counted, and the longest blocking time of each
+    greenlet is kept while the greenlet is alive.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.durations = LatencyHistogram()
+        self.stacks = {}
+        self.greenlets = weakref.WeakKeyDictionary()
+
+    def get_stack_key(self, frame):
+        """Returns the hash identifying the stack of `frame`."""
+        frames = []
+        while frame is not None:
+            frames.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        return hash(tuple(frames))
+
+    def record(self, duration, stack_key, stack, greenlet=None):
+        """Records a blocking of `duration` seconds in the given stack.
+
+        `stack` is the formatted stack, only kept the first time the stack
+        is seen.
+        """
+        duration = duration * 1000
+        self.durations.record(duration)
+        entry = self.stacks.get(stack_key)
+        if entry is None:
+            entry = self.stacks[stack_key] = {'count': 0, 'total': 0,
+                                              'max': 0, 'stack': stack}
+        entry['count'] += 1
+        entry['total'] += duration
+        entry['max'] = max(entry['max'], duration)
+        if greenlet is not None:
+            previous = self.greenlets.get(greenlet, 0)
+            self.greenlets[greenlet] = max(previous, duration)
+
+    def get_summary(self, size=BLOCKING_SUMMARY_SIZE):
+        """Returns a report of the `size` most blocking stacks."""
+        durations = self.durations.get_summary()
+        lines = ["Event-loop blocked %d times in %ds (p50 %dms, p99 %dms, "
+                 "max %dms)" % (durations['count'],
+                                time.time() - self.started,
+                                durations['p50'], durations['p99'],
+                                durations['max'])]
+        stacks = sorted(self.stacks.values(), key=lambda e: -e['total'])
+        for entry in stacks[:size]:
+            lines.append("\n%(count)d times, %(total)dms in total, "
+                         "%(max)dms max:" % entry)
+            lines.append("".join(entry['stack']).rstrip())
+        greenlets = sorted(self.greenlets.items(), key=lambda i: -i[1])
+        if greenlets:
+            lines.append("\nLongest blocking per greenlet:")
+        for greenlet, duration in greenlets[:size]:
+            lines.append("%dms: %r" % (duration, greenlet))
+        return "\n".join(lines)
+
 
 class MozSvcWorker(GeventWorker):
     """Custom gunicorn worker with extra operational niceties.
@@ -79,36 +173,32 @@ class MozSvcWorker(GeventWorker):
     but with some extra operational- and debugging-related features:
 
         * a background thread that monitors for blocking of the gevent
-          event-loop, and logs tracebacks if blocking code is found.
+          event-loop, and periodically logs a summary of the blocking code
+          found, also logged on SIGUSR1.
 
         * a timeout enforced on each individual request, rather than on
-          inactivity of the worker as a whole.
+          inactivity of the worker as a whole.  It is also set as the
+          request deadline, so backend calls shrink their own timeouts.
+
+        * a signal handler to report the growth of the object counts on
+          SIGUSR2, or to dump the whole heap if asked to.
 
-        * a signal handler to dump memory usage data on SIGUSR2.
+    The sampling profiler is driven from the profile page of the app, not
+    by a signal: the ones the workers leave free are the arbiter's, and
+    sending SIGTTIN to the wrong pid would add a worker.
 
-    To detect eventloop blocking, the worker installs a greenlet trace
-    function that increments a counter on each context switch.  A background
-    (os-level) thread monitors this counter and prints a traceback if it has
-    not changed within a configurable number of seconds.
+    To detect eventloop blocking, the worker starts a repeating timer on the
+    gevent hub that increments a heartbeat counter each time it fires.  A
+    background (os-level) thread monitors this counter and records a
+    traceback if it has not changed within a configurable number of seconds,
+    so nothing runs on each greenlet switch.
     """
 
     def init_process(self):
-        # Set up a greenlet tracing hook to monitor for event-loop blockage,
-        # but only if monitoring is both possible and required.
-        if hasattr(greenlet, "settrace") and MAX_BLOCKING_TIME > 0:
-            # Grab a reference to the gevent hub.
-            # It is needed in a background thread, but it only visible from
-            # the main thread, so we need to store a reference to it.
-            self._active_hub = gevent.hub.get_hub()
-            # Set up a trace function to record each greenlet switch.
-            self._active_greenlet = None
-            self._greenlet_switch_counter = 0
-            greenlet.settrace(self._greenlet_switch_tracer)
-            # Create a real thread to monitor for blocking of greenlets.
-            # Since this will be a long-running daemon thread, it's OK to
-            # fire-and-forget using the low-level start_new_thread function.
-            self._main_thread_id = _real_get_ident()
-            _real_start_new_thread(self._greenlet_blocking_monitor, ())
+        # Set up a heartbeat on the event-loop to monitor for blockage,
+        # but only if monitoring is required.
+        if MAX_BLOCKING_TIME > 0:
+            self._start_blocking_monitor()
 
         # Continue to superclass initialization logic.
         # Note that this runs the main loop and never returns.
@@ -120,71 +210,115 @@ class MozSvcWorker(GeventWorker):
 
         # Hook up SIGUSR2 to dump memory usage information.
         # This will be useful for debugging memory leaks and the like.
-        signal.signal(signal.SIGUSR2, self._dump_memory_usage)
+        self._memory_profiler = MemoryProfiler()
+        signal.signal(signal.SIGUSR2, self._handle_usr2)
         if hasattr(signal, "siginterrupt"):
             signal.siginterrupt(signal.SIGUSR2, False)
 
+    def handle_usr1(self, sig, frame):
+        # Reopen the log files, and log the blocking summary.
+        super(MozSvcWorker, self).handle_usr1(sig, frame)
+        self._blocking_summary_requested = True
+
     def handle_request(self, *args):
         # Apply the configured 'timeout' value to each individual request.
         # Note that self.timeout is set to half the configured timeout by
         # the arbiter, so we use the value directly from the config.
         with gevent.Timeout(self.cfg.timeout):
-            return super(MozSvcWorker, self).handle_request(*args)
+            with request_deadline(self.cfg.timeout):
+                return super(MozSvcWorker, self).handle_request(*args)
 
-    def _greenlet_switch_tracer(self, what, (origin, target)):
-        """Callback method executed on every greenlet switch.
+    def _start_blocking_monitor(self):
+        """Start the hub timer and the thread monitoring the event-loop.
 
-        The worker arranges for this method to be called on every greenlet
-        switch.  It keeps track of which greenlet is currently active and
-        increments a counter to track how many switches have been performed.
+        The monitoring thread stops once the timer is stopped.
+        """
+        # Set up a timer ticking twice per MAX_BLOCKING_TIME, so that a
+        # free event-loop always ticks between two checks.  It must not
+        # keep the loop alive on its own.
+        self._heartbeat_counter = 0
+        hub = gevent.hub.get_hub()
+        interval = MAX_BLOCKING_TIME / 2
+        self._heartbeat = hub.loop.timer(interval, interval)
+        self._heartbeat.ref = False
+        self._heartbeat.start(self._heartbeat_tick)
+        # Create a real thread to monitor for blocking of greenlets.
+        # Since this will be a long-running daemon thread, it's OK to
+        # fire-and-forget using the low-level start_new_thread function.
+        self._main_thread_id = _real_get_ident()
+        self._blocking_summary_requested = False
+        self._blocking_stats = BlockingStats()
+        _real_start_new_thread(self._greenlet_blocking_monitor, ())
+
+    def _heartbeat_tick(self):
+        """Callback method executed by the hub timer.
+
+        It increments a counter showing that the event-loop is running.
+        Python ints don't overflow, so there's no need to reset it.
         """
-        # Sanity-check that this function is being called on every
-        # greenlet switch.  Once we're confident it's working correctly
-        # then this can be removed.
-        if self._active_greenlet not in (None, origin):
-            msg = "MozSvcWorker missed a greenlet switch"
-            self._log_error(msg)
-        # Increment the counter to indicate that a switch took place.
-        # This will periodically be reset to zero by the monitoring thread,
-        # so we don't need to worry about it growing without bound.
-        self._active_greenlet = target
-        self._greenlet_switch_counter += 1
+        self._heartbeat_counter += 1
 
     def _greenlet_blocking_monitor(self):
-        """Method run in background thread that checks for regular switches.
-
-        This method is an endless loop that gets executed in a background
-        thread.  It periodically wakes up and checks whether the active
-        greenlet has switched since it was last checked.  If not then an
-        error log is generated.
-
-        The only exception is for the greenlet running the gevent Hub, which
-        is allowed to block indefinitely while waiting for I/O.
+        """Method run in background thread checking for regular heartbeats.
+
+        This method is a loop that gets executed in a background thread
+        for as long as the heartbeat timer is active.  It periodically wakes
+        up and checks whether the event-loop timer ticked since it was last
+        checked.  If not, the stack of the blocking code is captured and,
+        once the loop ticks again, the blocking is recorded in a
+        BlockingStats object.  A summary of the stats is logged every
+        BLOCKING_SUMMARY_INTERVAL seconds.
+
+        A blocking still in progress after MAX_BLOCKING_EPISODE seconds is
+        logged right away, since a worker wedged until the arbiter kills it
+        would otherwise never report anything.
+
+        The hub waiting for I/O does not count as blocking, since the timer
+        wakes it up.
         """
         try:
-            while True:
-                # Check the switch counter before and after a sleep.
-                # If it hasn't increased then the active greenlet is blocking.
-                old_switch_counter = self._greenlet_switch_counter
+            blocked_since = blocked = None
+            reported = False
+            while self._heartbeat.active:
+                stats = self._blocking_stats
+                # Check the heartbeat counter before and after a sleep.
+                # If it hasn't increased then something is blocking the loop.
+                old_heartbeat_counter = self._heartbeat_counter
+                checked_at = time.time()
                 _real_sleep(MAX_BLOCKING_TIME)
-                active_greenlet = self._active_greenlet
-                new_switch_counter = self._greenlet_switch_counter
-                # If we have detected a successful switch, reset the counter
-                # to zero.  This might race with it being incrememted in the
-                # other thread, but should succeed often enough to prevent
-                # the counter from growing without bound.
-                if new_switch_counter != old_switch_counter:
-                    self._greenlet_switch_counter = 0
+                if self._heartbeat_counter != old_heartbeat_counter:
+                    # The blocking is over, record how long it lasted.
+                    if blocked_since is not None:
+                        duration = time.time() - blocked_since
+                        stats.record(duration, *blocked)
+                        blocked_since = blocked = None
+                        reported = False
                 # If we detected a blocking greenlet, grab the stack trace
-                # and log an error.  The active greenlet's frame is not
-                # available from the greenlet object itself, we have to look
-                # up the current frame of the main thread for the traceback.
-                else:
-                    if active_greenlet not in (None, self._active_hub):
-                        frame = sys._current_frames()[self._main_thread_id]
-                        stack = traceback.format_stack(frame)
-                        err_log = ["Greenlet appears to be blocked\n"] + stack
-                        self._log_error("".join(err_log))
+                # once.  The active greenlet's frame is not available from
+                # the greenlet object itself, we have to look up the current
+                # frame of the main thread for the traceback.
+                elif blocked_since is None:
+                    frame = sys._current_frames()[self._main_thread_id]
+                    blocked = (stats.get_stack_key(frame),
+                               traceback.format_stack(frame),
+                               _get_frame_greenlet(frame))
+                    blocked_since = checked_at
+                elif not reported:
+                    duration = time.time() - blocked_since
+                    if duration >= MAX_BLOCKING_EPISODE:
+                        reported = True
+                        stack = "".join(blocked[1]).rstrip()
+                        self._log_error("Event-loop blocked for %dms so far, "
+                                        "in:\n%s" % (duration * 1000, stack))
+                # Log the summary periodically, or when asked to.
+                elapsed = time.time() - stats.started
+                if elapsed >= BLOCKING_SUMMARY_INTERVAL:
+                    if stats.stacks:
+                        self._log_error(stats.get_summary())
+                    self._blocking_stats = BlockingStats()
+                elif self._blocking_summary_requested:
+                    self._blocking_summary_requested = False
+                    self._log_error(stats.get_summary())
         except Exception:
             # Swallow any exceptions raised during interpreter shutdown.
             # Daemonic Thread objects have this same behaviour.
@@ -203,6 +337,33 @@ class MozSvcWorker(GeventWorker):
         else:
             print>>sys.stderr, msg
 
+    def _handle_usr2(self, sig, frame):
+        # Move the work out of the signal handler, so the worker keeps
+        # serving requests while the objects are counted.
+        if MEMORY_DUMP_FULL:
+            gevent.spawn(self._dump_memory_usage)
+        else:
+            gevent.spawn(self._report_memory_usage)
+
+    def _report_memory_usage(self):
+        """Write the growth of the object counts to a file.
+
+        This method writes out the types whose number of objects grew the
+        most since the previous report, and the size of the known caches,
+        into a timestamped file.  By default the data is written to a file
+        named /tmp/mozsvc-memdump.<pid>.<timestamp>.txt but this can be
+        customized with the environment variable "MOZSVC_MEMORY_DUMP_FILE".
+        """
+        now = int(time.time())
+        filename = "%s.%d.%d.txt" % (MEMORY_DUMP_FILE, os.getpid(), now)
+        try:
+            report = self._memory_profiler.get_report()
+            with open(filename, "w") as f:
+                f.write(report)
+        except Exception:
+            self._log_error("Could not report the memory usage in %r:\n%s"
+                            % (filename, traceback.format_exc()))
+
     def _dump_memory_usage(self, *args):
         """Dump memory usage data to a file.
 
@@ -211,6 +372,9 @@ class MozSvcWorker(GeventWorker):
         /tmp/mozsvc-memdump.<pid>.<timestamp> but this can be customized
         with the environment variable "MOSVC_MEMORY_DUMP_FILE".
 
+        It walks the whole heap and blocks the worker, so it is only used
+        if the environment variable "MOZSVC_MEMORY_DUMP_FULL" is set.
+
         If the "meliae" package is not installed or if an error occurs during
         processing, then the file "mozsvc-memdump.error.<pid>.<timestamp>"
         will be written with a traceback of the error.
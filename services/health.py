@@ -0,0 +1,211 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Health checks of the backends, for the heartbeat page.
+
+Backends register a probe: a callable that raises an exception when the
+backend is unhealthy.  The HealthChecker runs all the probes concurrently
+in the background, so the heartbeat page can serve the last known status
+without hitting any backend.
+
+The registry doesn't keep the backends alive: the probes given as bound
+methods, or with an owner, are dropped when their object is collected.
+"""
+import functools
+import os
+import time
+import threading
+import weakref
+
+from metlog.holder import CLIENT_HOLDER
+
+from services.events import subscribe, APP_ENDS
+
+
+# name -> (probe, weak reference to its owner or None)
+_BACKENDS = {}
+
+
+def register_backend(name, probe, owner=None):
+    """Registers the health probe of a backend.
+
+    If `owner` is given, the probe is called with it, and only a weak
+    reference to it is kept: the probe is removed once the owner is
+    collected.  A bound method is registered that way, with its object as
+    the owner.
+
+    A new probe registered under an existing name replaces the old one.
+    """
+    if owner is None and getattr(probe, 'im_self', None) is not None:
+        probe, owner = probe.im_func, probe.im_self
+    if owner is None:
+        _BACKENDS[name] = (probe, None)
+        return
+
+    def _collected(ref):
+        if _BACKENDS.get(name, (None, None))[1] is ref:
+            del _BACKENDS[name]
+
+    _BACKENDS[name] = (probe, weakref.ref(owner, _collected))
+
+
+def unregister_backend(name):
+    """Removes the health probe of a backend, if any."""
+    _BACKENDS.pop(name, None)
+
+
+def get_backends():
+    """Returns the probes of the registered backends, by name."""
+    backends = {}
+    for name, (probe, owner) in _BACKENDS.items():
+        if owner is None:
+            backends[name] = probe
+            continue
+        owner = owner()
+        if owner is not None:
+            backends[name] = functools.partial(probe, owner)
+    return backends
+
+
+class HealthChecker(object):
+    """Probes the registered backends every `interval` seconds.
+
+    Each probe is given `timeout` seconds to succeed.  A status older than
+    `max_age` seconds (by default three intervals) is reported as a failure,
+    so a stuck checker never looks healthy.
+
+    The background thread is started on the first call to get_status(), in
+    the process serving the requests, so that it survives the worker fork.
+    Its first check runs in the background too: until it is done, the
+    status is "pending" and reported as ok, unless it takes more than
+    `max_age` seconds.  The thread is stopped on APP_ENDS.
+    """
+    def __init__(self, interval=10, timeout=5, max_age=None, backends=None):
+        self.interval = float(interval)
+        self.timeout = float(timeout)
+        if max_age is None:
+            max_age = self.interval * 3
+        self.max_age = float(max_age)
+        self.backends = backends
+        self._status = None
+        self._pid = self._checker = None
+        self._probing = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        subscribe(APP_ENDS, self.stop, weak=True)
+
+    def get_status(self):
+        """Returns the last known status of the backends.
+
+        The status is a mapping with an "ok" flag, the time of the "check"
+        and the status of each backend under "backends".
+        """
+        if self._pid != os.getpid():
+            self._start()
+        status = self._status
+        if time.time() - status['checked'] > self.max_age:
+            status = dict(status, ok=False, error='status is outdated')
+        return status
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # the heartbeat doesn't wait for the first check
+            self._status = {'ok': True, 'pending': True,
+                            'checked': time.time(), 'backends': {}}
+            self._checker = threading.Thread(target=self._run)
+            self._checker.daemon = True
+            self._checker.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.check()
+            except Exception:
+                CLIENT_HOLDER.default_client.exception('Health check failed')
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """Stops the background checks."""
+        self._stopped.set()
+
+    def check(self):
+        """Runs all the probes concurrently and records the status."""
+        results = {}
+        probes = []
+        backends = self.backends
+        if backends is None:
+            backends = get_backends()
+        for name, probe in backends.items():
+            # don't pile up probes on a backend that is hanging
+            previous = self._probing.get(name)
+            if previous is not None and previous.is_alive():
+                results[name] = {'ok': False, 'latency': None,
+                                 'error': 'previous check still running'}
+                continue
+            outcome = {}
+            prober = threading.Thread(target=self._probe,
+                                      args=(probe, outcome))
+            prober.daemon = True
+            prober.start()
+            self._probing[name] = prober
+            probes.append((name, prober, outcome))
+
+        deadline = time.time() + self.timeout
+        for name, prober, outcome in probes:
+            prober.join(max(deadline - time.time(), 0))
+            if outcome:
+                results[name] = dict(outcome)
+            else:
+                results[name] = {'ok': False, 'latency': None,
+                                 'error': 'timed out'}
+
+        ok = len([1 for result in results.values() if not result['ok']]) == 0
+        self._status = {'ok': ok, 'checked': time.time(), 'backends': results}
+        return self._status
+
+    def _probe(self, probe, outcome):
+        start = time.time()
+        try:
+            probe()
+        except Exception, err:
+            result = {'ok': False,
+                      'error': '%s: %s' % (err.__class__.__name__, err)}
+        else:
+            result = {'ok': True, 'error': None}
+        result['latency'] = time.time() - start
+        outcome.update(result)
@@ -40,6 +40,9 @@ import socket
 import base64
 from urlparse import urlparse, urlunparse
 
+from services.util import get_circuit_breaker, clamp_timeout
+from services.metrics import backend_timer
+
 
 def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
             get_body=True, extra_headers=None):
@@ -48,13 +51,20 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
     This function is to be used to provide a gateway service.
 
     If the url is not answering after `timeout` seconds, the function will
-    return a (504, {}, error).
+    return a (504, {}, error).  The timeout is shortened to fit in the
+    current request deadline, if any.
 
     If the url is not reachable at all, the function will
     return (502, {}, error)
 
     Other errors are managed by the urrlib2.urllopen call.
 
+    Calls to each server go through a circuit breaker.  After too many
+    servers not reachable or timing out, calls fail fast by raising a
+    CircuitOpenError until the server is tried again.  The statuses sent
+    back by the server itself, 503 included, are not failures: they may
+    be the answers of an upstream application, passed through proxy().
+
     Args:
         - url: url to visit
         - method: method to use
@@ -82,6 +92,27 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
         for name, value in extra_headers.items():
             req.add_header(name, value)
 
+    timeout = clamp_timeout(timeout)
+    parsed = urlparse(url)
+    breaker = get_circuit_breaker('%s://%s' % (parsed.scheme, parsed.netloc))
+    breaker.allow()
+    # anything escaping is a failure too, so that a half-open breaker
+    # always gets the outcome of its trial call
+    failed = True
+    try:
+        with backend_timer('http'):
+            status, headers, body, failed = _urlopen(req, timeout, get_body)
+    finally:
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return status, headers, body
+
+
+def _urlopen(req, timeout, get_body):
+    """Returns the status, headers and body, and whether the server could
+    not be reached."""
     try:
         res = urllib2.urlopen(req, timeout=timeout)
     except urllib2.HTTPError, e:
@@ -95,19 +126,19 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
         else:
             body = ''
 
-        return e.code, headers, body
+        return e.code, headers, body, False
 
     except urllib2.URLError, e:
         if isinstance(e.reason, socket.timeout):
-            return 504, {}, str(e)
-        return 502, {}, str(e)
+            return 504, {}, str(e), True
+        return 502, {}, str(e), True
 
     if get_body:
         body = res.read()
     else:
         body = ''
 
-    return res.getcode(), dict(res.headers), body
+    return res.getcode(), dict(res.headers), body, False
 
 
 def proxy(request, scheme, netloc, timeout=5):
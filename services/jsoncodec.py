@@ -0,0 +1,111 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+JSON codec used across services.
+
+The fastest available implementation is picked once at import time:
+simplejson with its C speedups, which encode Decimal values (such as the
+timestamps of round_time) natively, or the standard json module, for
+which Decimal values are encoded through a default hook.  Both write
+Decimal values exactly as they are.  The encoder and decoder objects are
+built once, instead of on every call like dumps() and loads() do when
+they get extra options.
+
+services/tests/bench_jsoncodec.py compares the implementations on
+representative payloads.
+"""
+from decimal import Decimal
+
+try:
+    import simplejson
+    _HAS_SPEEDUPS = simplejson._import_c_make_encoder() is not None
+except ImportError:
+    simplejson = None
+    _HAS_SPEEDUPS = False
+import json
+
+
+class _DecimalLiteral(long):
+    """Stands for a Decimal in the output of the json module.
+
+    The json module writes floats with float.__repr__, which can't be
+    overridden, but integers with str(), so this long writes the exact
+    string of the Decimal, like simplejson does.
+    """
+    def __new__(cls, value):
+        literal = long.__new__(cls)
+        literal.text = str(value)
+        return literal
+
+    def __str__(self):
+        return self.text
+
+    __repr__ = __str__
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return _DecimalLiteral(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def _get_codec(name):
+    """Returns the encode and decode functions of the named codec."""
+    if name == 'simplejson':
+        encoder = simplejson.JSONEncoder(use_decimal=True)
+        decoder = simplejson.JSONDecoder()
+    elif name == 'json':
+        encoder = json.JSONEncoder(default=_default)
+        decoder = json.JSONDecoder()
+    else:
+        raise ValueError('Unknown JSON codec %r' % name)
+    return encoder.encode, decoder.decode
+
+
+def set_codec(name=None):
+    """Switches to the named codec, "simplejson" or "json".
+
+    By default the fastest available one is used.
+    """
+    global dumps, loads, codec_name
+    if name is None:
+        name = 'simplejson' if _HAS_SPEEDUPS else 'json'
+    dumps, loads = _get_codec(name)
+    codec_name = name
+
+
+codec_name = None
+dumps = loads = None
+set_codec()
@@ -43,6 +43,11 @@ from ldap.ldapobject import ReconnectLDAPObject
 import ldap
 from services.exceptions import (BackendError, BackendTimeoutError,
                                  MaxConnectionReachedError)
+from services.util import get_circuit_breaker, clamp_timeout
+from services.health import register_backend
+from services.memory import register_cache
+from services.events import subscribe, unsubscribe, APP_ENDS
+from services.metrics import backend_timer
 
 
 class StateConnector(ReconnectLDAPObject):
@@ -103,6 +108,13 @@ class StateConnector(ReconnectLDAPObject):
         return self._apply_method_s(ReconnectLDAPObject.modify_s, *args,
                                     **kwargs)
 
+    def search_st(self, base, scope, filterstr='(objectClass=*)',
+                  attrlist=None, attrsonly=0, timeout=-1):
+        # never wait past the deadline of the current request
+        timeout = clamp_timeout(timeout)
+        return ReconnectLDAPObject.search_st(self, base, scope, filterstr,
+                                             attrlist, attrsonly, timeout)
+
 
 class ConnectionManager(object):
     """LDAP Connection Manager.
@@ -126,6 +138,9 @@ class ConnectionManager(object):
         self.connector_cls = connector_cls
         self.use_pool = use_pool
         self.max_lifetime = max_lifetime
+        register_backend(uri, self.check_health)
+        register_cache('ldap.pool', self, len)
+        subscribe(APP_ENDS, self.close, weak=True)
 
     def __len__(self):
         return len(self._pool)
@@ -279,16 +294,40 @@ class ConnectionManager(object):
     def connection(self, bind=None, passwd=None):
         """Creates a context'ed connector, binds it, and returns it
 
+        Connections go through the circuit breaker of the server, and
+        a CircuitOpenError is raised straight away while it is open.  The
+        connector timeout is shortened to fit in the request deadline.
+
+        The time spent with the connector is recorded in the metlog data of
+        the request, as 'ldap_time'.
+
         Args:
             - bind: login
             - passwd: password
         """
+        with backend_timer('ldap'):
+            with self._connection(bind, passwd) as conn:
+                yield conn
+
+    @contextmanager
+    def _connection(self, bind=None, passwd=None):
+        clamp_timeout(self.timeout)
+        breaker = get_circuit_breaker(self.uri)
+        breaker.allow()
 
         tries = 0
         conn = None
         while tries < self.retry_max:
             try:
                 conn = self._get_connection(bind, passwd)
+            except BackendError:
+                breaker.record_failure()
+                raise
+            except (ldap.NO_SUCH_OBJECT, ldap.INVALID_CREDENTIALS,
+                    ldap.INVALID_DN_SYNTAX):
+                # the server did answer
+                breaker.record_success()
+                raise
             except MaxConnectionReachedError:
                 tries += 1
                 time.sleep(0.1)
@@ -300,17 +339,48 @@ class ConnectionManager(object):
                         if not conn_.active:
                             self._pool.pop(index)
                             break
+            except Exception:
+                breaker.record_failure()
+                raise
             else:
                 break
 
         if conn is None:
+            # a half-open breaker must get the outcome of its trial
+            breaker.record_failure()
             raise MaxConnectionReachedError(self.uri)
 
+        conn.timeout = clamp_timeout(self.timeout)
         try:
             yield conn
+        except (BackendError, ldap.TIMEOUT, ldap.SERVER_DOWN):
+            breaker.record_failure()
+            raise
+        except Exception:
+            breaker.record_success()
+            raise
+        else:
+            breaker.record_success()
         finally:
             self._release_connection(conn)
 
+    def check_health(self):
+        """Binds a connector, to make sure the server is working."""
+        with self.connection():
+            pass
+
+    def close(self):
+        """Unbinds and drops all the connectors of the pool."""
+        unsubscribe(APP_ENDS, self.close)
+        with self._pool_lock:
+            for conn in self._pool:
+                try:
+                    conn.unbind_ext_s()
+                except ldap.LDAPError:
+                    # invalid state
+                    pass
+            self._pool = []
+
     def purge(self, bind, passwd=None):
         """Purge a connector
 
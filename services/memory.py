@@ -0,0 +1,131 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Lightweight memory diagnostics.
+
+Instead of dumping the whole heap, the MemoryProfiler counts the objects
+tracked by the garbage collector per type, and reports the types whose
+count grew the most since the previous snapshot.  The sizes of the caches
+registered with register_cache() are reported too.
+"""
+import gc
+import time
+import weakref
+
+
+_CACHES = {}
+
+
+def register_cache(name, owner, get_size):
+    """Registers a cache to report in the memory diagnostics.
+
+    `get_size` is called with `owner` and returns the size of the cache.
+    Only a weak reference to `owner` is kept, the cache is forgotten once
+    it's garbage collected.  The sizes of the caches registered under the
+    same name are added up.
+    """
+    def _forget(ref):
+        _CACHES.pop(id(ref), None)
+    ref = weakref.ref(owner, _forget)
+    _CACHES[id(ref)] = (name, ref, get_size)
+
+
+def get_cache_sizes():
+    """Returns a mapping of the registered cache names to their sizes."""
+    sizes = {}
+    for name, ref, get_size in _CACHES.values():
+        owner = ref()
+        if owner is not None:
+            sizes[name] = sizes.get(name, 0) + get_size(owner)
+    return sizes
+
+
+def _get_type_name(typ):
+    module = getattr(typ, '__module__', None)
+    if module in (None, '__builtin__'):
+        return typ.__name__
+    return '%s.%s' % (module, typ.__name__)
+
+
+class MemoryProfiler(object):
+    """Reports the growth of the object counts between two snapshots.
+
+    Only the objects tracked by the garbage collector (containers and
+    instances, not strings or numbers) are counted.  They are counted
+    `batch_size` at a time, calling time.sleep(0) in between, so under
+    gevent the other greenlets keep running during the count.
+    """
+    def __init__(self, batch_size=10000, top=20):
+        self.batch_size = batch_size
+        self.top = top
+        self.counts = None
+
+    def snapshot(self):
+        """Returns the number of objects per type."""
+        counts = {}
+        objects = gc.get_objects()
+        try:
+            for start in xrange(0, len(objects), self.batch_size):
+                for obj in objects[start:start + self.batch_size]:
+                    typ = type(obj)
+                    counts[typ] = counts.get(typ, 0) + 1
+                time.sleep(0)
+        finally:
+            del objects
+        return counts
+
+    def get_report(self):
+        """Takes a snapshot and returns a report of the growth since the
+        previous one.  The first report lists the most common types.
+        """
+        counts = self.snapshot()
+        previous, self.counts = self.counts, counts
+        if previous is None:
+            title = 'Most common types'
+            growth = [(count, count, typ) for typ, count in counts.items()]
+        else:
+            title = 'Top growing types'
+            growth = [(count - previous.get(typ, 0), count, typ)
+                      for typ, count in counts.items()]
+            growth = [item for item in growth if item[0] > 0]
+        growth.sort(reverse=True)
+
+        lines = ['%d objects tracked' % sum(counts.values()), '', title]
+        for delta, count, typ in growth[:self.top]:
+            lines.append('%+8d %8d %s' % (delta, count, _get_type_name(typ)))
+        lines.extend(['', 'Caches'])
+        for name, size in sorted(get_cache_sizes().items()):
+            lines.append('%8d %s' % (size, name))
+        return '\n'.join(lines) + '\n'
@@ -41,11 +41,14 @@ from contextlib import contextmanager
 from metlog.config import client_from_stream_config
 from metlog.decorators.base import MetlogDecorator
 from metlog.decorators.stats import timeit
+from metlog.decorators.stats import incr_count
 from metlog.holder import CLIENT_HOLDER
+import random
 import threading
+import time
 
-
-_LOCAL_STORAGE = threading.local()
+from services.memory import register_cache
+from services.context import request_context, get_context_value
 
 
 def MetlogLoader(**kwargs):
@@ -57,43 +60,254 @@ def MetlogLoader(**kwargs):
     return CLIENT_HOLDER
 
 
+class LatencyHistogram(object):
+    """
+    Fixed-memory histogram of non-negative integer values, HDR-style.
+
+    Values below 2 ** `precision_bits` get their own bucket.  Above, each
+    power of two is split into 2 ** (`precision_bits` - 1) linear buckets,
+    so the relative error stays under 2 ** (1 - `precision_bits`).  Values
+    above `max_value` are counted in the last bucket, the exact min, max
+    and sum are kept aside.
+    """
+    def __init__(self, max_value=2 ** 32, precision_bits=7):
+        self.precision_bits = precision_bits
+        self.max_value = max_value
+        self._lock = threading.Lock()
+        self._counts = [0] * (self._get_index(max_value) + 1)
+        self.reset()
+
+    def _get_index(self, value):
+        bits = self.precision_bits
+        if value < 1 << bits:
+            return value
+        shift = value.bit_length() - bits
+        return (shift << (bits - 1)) + (value >> shift)
+
+    def _get_upper_bound(self, index):
+        bits = self.precision_bits
+        if index < 1 << bits:
+            return index
+        shift = (index >> (bits - 1)) - 1
+        return ((index - (shift << (bits - 1)) + 1) << shift) - 1
+
+    def reset(self):
+        """Empties the histogram."""
+        with self._lock:
+            self._counts[:] = [0] * len(self._counts)
+            self.count = self.total = self.max = 0
+            self.min = None
+
+    def record(self, value):
+        """Records a value."""
+        value = int(value)
+        index = self._get_index(max(0, min(value, self.max_value)))
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+            if self.min is None or value < self.min:
+                self.min = value
+
+    def get_percentile(self, percentile):
+        """Returns the value under which `percentile`% of the values are."""
+        with self._lock:
+            if self.count == 0:
+                return 0
+            rank = self.count * percentile / 100.
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if count and seen >= rank:
+                    break
+            if index == len(self._counts) - 1:
+                # the values above max_value are only known by the max
+                return self.max
+            value = self._get_upper_bound(index)
+            return max(self.min, min(value, self.max))
+
+    def get_summary(self, percentiles=(50, 90, 99)):
+        """Returns the count, min, max, mean and percentiles as a mapping."""
+        summary = {'count': self.count, 'sum': self.total,
+                   'min': self.min or 0, 'max': self.max,
+                   'mean': self.total / float(self.count or 1)}
+        for percentile in percentiles:
+            summary['p%d' % percentile] = self.get_percentile(percentile)
+        return summary
+
+
+class MetricsAggregator(object):
+    """
+    Accumulates counters and timers in-process and sends summaries through
+    metlog every `flush_interval` seconds, instead of one message per event.
+
+    Timers are kept in LatencyHistograms, so the memory used doesn't depend
+    on the traffic.  For each timer a 'timer_summary' message is sent with
+    the count, min, max, mean and the `percentiles`.  The flush happens on
+    the first event recorded after the interval elapsed.
+    """
+    def __init__(self, flush_interval=10, percentiles=(50, 90, 99),
+                 client=None):
+        self.flush_interval = float(flush_interval)
+        self.percentiles = percentiles
+        self._client = client
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._last_flush = time.time()
+
+    @property
+    def client(self):
+        if self._client is None:
+            return CLIENT_HOLDER.default_client
+        return self._client
+
+    def incr(self, name, count=1):
+        """Increments the counter `name`."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + count
+        self._maybe_flush()
+
+    def timing(self, name, elapsed):
+        """Records a duration of `elapsed` ms for the timer `name`."""
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = LatencyHistogram()
+        timer.record(elapsed)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends the accumulated metrics through metlog and resets them."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            timers, self._timers = self._timers, {}
+            self._last_flush = time.time()
+
+        client = self.client
+        for name, count in counters.items():
+            client.incr(name, count=count)
+        for name, timer in timers.items():
+            fields = timer.get_summary(self.percentiles)
+            fields['name'] = name
+            client.metlog('timer_summary', payload=str(fields['count']),
+                          fields=fields)
+
+
+_AGGREGATOR = None
+_SERVICES_SAMPLE_RATE = 1.
+
+
+def configure_metrics(aggregate=False, flush_interval=10,
+                      services_sample_rate=1., **kw):
+    """
+    Sets up the metrics sent by the decorators below.
+
+    If `aggregate` is True, counters and timers are accumulated by a
+    MetricsAggregator flushing every `flush_interval` seconds.  Only a
+    `services_sample_rate` fraction of the 'services' messages are sent.
+
+    The other options of the "metrics" section are ignored.
+    """
+    global _AGGREGATOR, _SERVICES_SAMPLE_RATE
+    flush_metrics()
+    if aggregate:
+        _AGGREGATOR = MetricsAggregator(flush_interval=flush_interval)
+        register_cache('metrics.aggregator', _AGGREGATOR,
+                       lambda aggregator: (len(aggregator._counters) +
+                                           len(aggregator._timers)))
+    else:
+        _AGGREGATOR = None
+    _SERVICES_SAMPLE_RATE = float(services_sample_rate)
+
+
+def get_aggregator():
+    """Returns the MetricsAggregator in use, or None."""
+    return _AGGREGATOR
+
+
+def flush_metrics():
+    """Sends what the aggregator accumulated so far, if there's one."""
+    if _AGGREGATOR is not None:
+        _AGGREGATOR.flush()
+
+
 def update_metlog_data(update_data):
     """
     Update the 'metlog_data' dictionary for this request w/ the provided data.
     """
-    if not hasattr(_LOCAL_STORAGE, 'metlog_data'):
+    metlog_data = get_context_value('metlog_data')
+    if metlog_data is None:
         raise AttributeError("No `metlog_data`; are you in a "
                              "thread_context?")
-    _LOCAL_STORAGE.metlog_data.update(update_data)
+    metlog_data.update(update_data)
+
+
+class backend_timer(object):
+    """
+    Context manager that adds the wall time spent in the block, and a call
+    count, to the 'metlog_data' of the request under '<backend>_time' and
+    '<backend>_count'.  Outside of a thread_context it does nothing.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.metlog_data = None
+
+    def __enter__(self):
+        self.metlog_data = get_context_value('metlog_data')
+        if self.metlog_data is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        metlog_data = self.metlog_data
+        if metlog_data is None:
+            return
+        duration = time.time() - self.start
+        count_key = self.backend + '_count'
+        time_key = self.backend + '_time'
+        metlog_data[count_key] = metlog_data.get(count_key, 0) + 1
+        metlog_data[time_key] = metlog_data.get(time_key, 0) + duration
 
 
 @contextmanager
 def thread_context(callback):
     """
     This is a context manager that accepts a callback function and returns a
-    thread local dictionary object. Upon exit, the callback function will be
-    called and passed that dictionary as the sole argument, after which the
-    dictionary will be deleted.
+    dictionary object stored in the request context. Upon exit, the callback
+    function will be called and passed that dictionary as the sole argument.
+    Nested contexts get their own dictionary, the outer one is restored when
+    they exit.
     """
-    _LOCAL_STORAGE.metlog_data = dict()
-    yield _LOCAL_STORAGE.metlog_data
-    try:
-        if _LOCAL_STORAGE.metlog_data:
-            callback(_LOCAL_STORAGE.metlog_data)
-    finally:
-        del _LOCAL_STORAGE.metlog_data
+    with request_context(metlog_data=dict()) as context:
+        metlog_data = context['metlog_data']
+        yield metlog_data
+    if metlog_data:
+        callback(metlog_data)
 
 
 class send_services_data(MetlogDecorator):
     """
-    Decorator that wraps a function with a threadlocal metlog data dictionary.
+    Decorator that wraps a function with a per-request metlog data dictionary.
     Anything written into this dictionary from within the decorated code will
-    be sent as a 'services' message through metlog when the function returns.
+    be sent as a 'services' message through metlog when the function returns,
+    for the configured sample of the requests.
     """
     def metlog_call(self, *args, **kwargs):
         req = args[0]
+        rate = _SERVICES_SAMPLE_RATE
 
         def send_logmsg(metlog_data):
+            if rate < 1:
+                if random.random() >= rate:
+                    return
+                metlog_data['rate'] = rate
             self.client.metlog('services', fields=metlog_data)
 
         with thread_context(send_logmsg) as metlog_data:
@@ -110,7 +324,36 @@ class svc_timeit(timeit):
             self.args = tuple()
         if self.kwargs is None:
             self.kwargs = {'name': self._fn_fq_name}
-        with self.client.timer(*self.args, **self.kwargs) as timer:
-            result = self._fn(*args, **kwargs)
-        update_metlog_data({'req_time': timer.result})
-        return result
+        aggregator = _AGGREGATOR
+        if aggregator is None:
+            with self.client.timer(*self.args, **self.kwargs) as timer:
+                result = self._fn(*args, **kwargs)
+            update_metlog_data({'req_time': timer.result})
+            return result
+
+        start = time.time()
+        try:
+            return self._fn(*args, **kwargs)
+        finally:
+            elapsed = int(round((time.time() - start) * 1000))
+            name = self.args[0] if self.args else self.kwargs['name']
+            aggregator.timing(name, elapsed)
+            update_metlog_data({'req_time': elapsed})
+
+
+class svc_incr_count(incr_count):
+    """
+    Increment a counter whenever the callable is invoked, through the
+    aggregator if there is one.
+    """
+    def metlog_call(self, *args, **kwargs):
+        aggregator = _AGGREGATOR
+        if aggregator is None:
+            return super(svc_incr_count, self).metlog_call(*args, **kwargs)
+        if self.kwargs is None:
+            self.kwargs = {'name': self._fn_fq_name, 'count': 1}
+        try:
+            return self._fn(*args, **kwargs)
+        finally:
+            name = self.args[0] if self.args else self.kwargs['name']
+            aggregator.incr(name, self.kwargs.get('count', 1))
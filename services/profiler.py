@@ -0,0 +1,152 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Statistical profiler, cheap enough to be turned on in production.
+
+Instead of tracing every call, a timer signal interrupts the process every
+`interval` seconds of CPU time and the stack of the code running at that
+moment is counted.  Under gevent, the running code is the active greenlet,
+so each sample is the stack of the greenlet that was using the CPU; idle
+time spent waiting in the hub uses no CPU and is not sampled.
+
+The samples are returned in the "collapsed stacks" format used by
+flamegraph.pl and compatible tools: one line per distinct stack, with
+the frames separated by semicolons from the outermost one, followed by
+the number of samples.
+"""
+import signal
+
+from services.memory import register_cache
+
+
+class SamplingProfiler(object):
+    """Samples the stack every `interval` seconds of CPU time.
+
+    At most `max_stacks` distinct stacks are kept, the samples of the
+    other ones are counted under a "(truncated)" stack.  The names of at
+    most `max_frames` code objects are cached.
+
+    The signal handler can only be installed from the main thread, so
+    start() raises a ValueError in the other ones.  The handler runs there
+    too, between two bytecodes, so no lock is taken: the dict of the
+    samples is only replaced or copied with atomic operations.
+    """
+    def __init__(self, interval=0.005, max_stacks=10000, max_frames=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_frames = max_frames
+        self.running = False
+        self._frame_names = {}
+        self.reset()
+
+    def reset(self):
+        """Forgets all the samples taken so far."""
+        self._stacks = {}
+        self.samples = 0
+
+    def start(self):
+        """Starts sampling.  Does nothing if already running.
+
+        Raises a ValueError if not called from the main thread.
+        """
+        if self.running:
+            return
+        try:
+            signal.signal(signal.SIGPROF, self._sample)
+        except ValueError:
+            raise ValueError('The profiler can only be started from the '
+                             'main thread')
+        if hasattr(signal, "siginterrupt"):
+            signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        """Stops sampling.  The samples are kept until reset() is called."""
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        try:
+            signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        except ValueError:
+            # not in the main thread, but the timer is off anyway
+            pass
+        self.running = False
+
+    def toggle(self, *args):
+        """Starts or stops sampling.  Can be used as a signal handler."""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _get_frame_name(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            name = '%s (%s:%d)' % (code.co_name, code.co_filename,
+                                   code.co_firstlineno)
+            if len(self._frame_names) >= self.max_frames:
+                # code compiled at runtime would grow it forever
+                self._frame_names = {}
+            self._frame_names[code] = name
+        return name
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(self._get_frame_name(frame.f_code))
+            frame = frame.f_back
+        names.reverse()
+        stack = ';'.join(names)
+        stacks = self._stacks
+        if stack not in stacks and len(stacks) >= self.max_stacks:
+            stack = '(truncated)'
+        stacks[stack] = stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def get_collapsed_stacks(self):
+        """Returns the samples in the collapsed stacks format."""
+        stacks = sorted(self._stacks.items())
+        return ''.join(['%s %d\n' % stack for stack in stacks])
+
+
+_PROFILER = SamplingProfiler()
+register_cache('profiler.stacks', _PROFILER,
+               lambda profiler: len(profiler._stacks))
+
+
+def get_profiler():
+    """Returns the profiler shared by the process."""
+    return _PROFILER
@@ -39,7 +39,7 @@
 import re
 import string
 
-from services.util import randchar
+from services.util import randstring
 from services.user import NoUserIDError
 
 
@@ -72,11 +72,8 @@ class ResetCode(object):
             reset code
         """
         chars = string.ascii_uppercase + string.digits
-
-        def _4chars():
-            return ''.join([randchar(chars) for i in range(4)])
-
-        code = '-'.join([_4chars() for i in range(4)])
+        rand = randstring(16, chars)
+        code = '-'.join([rand[i:i + 4] for i in range(0, 16, 4)])
         return code
 
     def _check_reset_code(self, code):
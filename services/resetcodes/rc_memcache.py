@@ -43,6 +43,7 @@ from memcache import Client
 
 from services.resetcodes import ResetCode
 from services.util import BackendError
+from services.health import register_backend
 
 _6HOURS = 21600
 
@@ -58,6 +59,14 @@ class ResetCodeMemcache(ResetCode):
         self._engine = Client(nodes, debug)
         self.product = product
         self.expiration = expiration
+        register_backend('memcache:' + ','.join(nodes), self.check_health)
+        # the client is a threading.local with sockets per thread, which
+        # only that thread can close: they are closed at process exit.
+
+    def check_health(self):
+        """Checks that memcached is answering."""
+        if not self._engine.set('heartbeat:%s' % self.product, 1, 60):
+            raise BackendError('memcached error')
 
     #
     # Private methods
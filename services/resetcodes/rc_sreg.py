@@ -37,9 +37,9 @@
 """ Authentication tool
 """
 import urlparse
-import json
 
 from metlog.holder import CLIENT_HOLDER
+from services import jsoncodec
 from services.exceptions import BackendError
 from services.http_helpers import get_url
 from services.auth import NoEmailError
@@ -113,12 +113,12 @@ class ResetCodeSreg(ResetCode):
         - netloc: proxy location
         """
         if data is not None:
-            data = json.dumps(data)
+            data = jsoncodec.dumps(data)
 
         status, headers, body = get_url(url, method, data, headers)
         if body:
             try:
-                body = json.loads(body)
+                body = jsoncodec.loads(body)
             except Exception:
                 self.logger.error("bad json body from sreg (%s): %s" %
                                   (url, body))
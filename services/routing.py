@@ -0,0 +1,117 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Index of the URL templates, to answer unknown URLs before routing.
+"""
+import re
+
+_VAR = re.compile(r'\{(\w+)(?::([^{}]*))?\}')
+
+
+class RouteIndex(object):
+    """Tells cheaply whether a path can match one of the URL templates.
+
+    The literal first segments of the templates are kept in a set, and the
+    dynamic ones are compiled into a single regular expression, so that
+    most paths that can't match any template are rejected without going
+    through the routes one by one.  The methods allowed on each literal
+    template are kept too, to tell a 405 from a 404 without routing the
+    path a second time.
+
+    Templates using the old ":name" or "*name" syntax disable the index,
+    since their variables can span several segments.  The "requirements"
+    of a route are used like the inline ones, and may span segments too.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.segments = set()
+        self.patterns = []
+        self.methods = {}
+        self._prefix = None
+
+    def add(self, template, verbs, requirements=None):
+        """Adds a URL template, served for the given methods.
+
+        `requirements` maps the variables of the template to the regular
+        expressions they must match, as passed to the mapper.
+        """
+        requirements = requirements or {}
+        if not template.startswith('/'):
+            self.enabled = False
+            return
+
+        if '{' not in template:
+            self.methods.setdefault(template, set()).update(verbs)
+
+        # building the pattern of the first segment
+        pattern = []
+        pos = 1
+        while pos < len(template) and template[pos] != '/':
+            match = _VAR.match(template, pos)
+            if match is not None:
+                name, regexp = match.groups()
+                regexp = regexp or requirements.get(name, '[^/]+')
+                pattern.append('(?:%s)' % regexp)
+                pos = match.end()
+                continue
+            char = template[pos]
+            if char in ':*{}':
+                self.enabled = False
+                return
+            pattern.append(re.escape(char))
+            pos += 1
+
+        segment = template[1:pos]
+        if '{' not in segment:
+            self.segments.add(segment)
+        else:
+            self.patterns.append(''.join(pattern))
+            self._prefix = re.compile(r'(?:%s)(?:/|\Z)'
+                                      % '|'.join(self.patterns))
+
+    def is_routable(self, path):
+        """Returns False if the path can't match any template."""
+        if not self.enabled or not path.startswith('/'):
+            return True
+        if path[1:].split('/', 1)[0] in self.segments:
+            return True
+        return self._prefix is not None and \
+            self._prefix.match(path, 1) is not None
+
+    def get_methods(self, path):
+        """Returns the methods allowed on a literal template, or None."""
+        if not self.enabled:
+            return None
+        return self.methods.get(path)
@@ -0,0 +1,73 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""Compares the JSON codecs on representative payloads.
+
+Run it with "python -m services.tests.bench_jsoncodec".
+"""
+import timeit
+from decimal import Decimal
+
+from services import jsoncodec
+
+
+def benchmark(number=1000):
+    payloads = {
+        'wbo list': [{'id': 'item%d' % i, 'sortindex': i,
+                      'modified': Decimal('1325192345.%02d' % (i % 100)),
+                      'payload': '{"ciphertext": "%s"}' % ('x' * 200)}
+                     for i in range(100)],
+        'timestamp': Decimal('1325192345.12'),
+        'user data': {'userid': 123, 'username': 'tarek',
+                      'mail': 'tarek@mozilla.com', 'syncNode': 'node1'},
+    }
+    codecs = ['json']
+    if jsoncodec.simplejson is not None:
+        codecs.append('simplejson')
+
+    for title, payload in sorted(payloads.items()):
+        print title
+        for name in codecs:
+            encode, decode = jsoncodec._get_codec(name)
+            data = encode(payload)
+            encoding = min(timeit.repeat(lambda: encode(payload),
+                                         number=number, repeat=3))
+            decoding = min(timeit.repeat(lambda: decode(data),
+                                         number=number, repeat=3))
+            print '  %-12s encode %8.2fus  decode %8.2fus' % (
+                        name, encoding * 1e6 / number, decoding * 1e6 / number)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,85 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from services.admission import AdmissionController
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_static_limit(self):
+        controller = AdmissionController(initial_concurrency=2,
+                                         adaptive=False)
+        self.assertTrue(controller.acquire())
+        self.assertTrue(controller.acquire())
+        self.assertFalse(controller.acquire())
+        controller.release(10.)
+        self.assertTrue(controller.acquire())
+
+        state = controller.get_state()
+        self.assertEqual(state['in_flight'], 2)
+        self.assertEqual(state['limit'], 2)
+        self.assertEqual(state['admitted'], 3)
+        self.assertEqual(state['rejected'], 1)
+
+    def test_adaptive_limit(self):
+        controller = AdmissionController(initial_concurrency=10,
+                                         min_concurrency=2,
+                                         max_concurrency=20)
+
+        def run(count, latency):
+            for i in range(count):
+                self.assertTrue(controller.acquire())
+            for i in range(count):
+                controller.release(latency)
+
+        # a busy server with a steady latency gets a higher limit
+        for i in range(20):
+            run(int(controller.limit), .01)
+        self.assertEqual(controller.get_state()['limit'], 20)
+
+        # when the latency goes up, the limit goes down
+        for i in range(20):
+            run(int(controller.limit), .5)
+        self.assertTrue(controller.get_state()['limit'] <= 4)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAdmissionController))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -35,18 +35,24 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import base64
+import simplejson as json
 import os.path
+import time
 import threading
 from time import sleep
 
 from services.baseapp import SyncServerApp
+from services.health import HealthChecker
+from services.profiler import get_profiler
+from services.user import LazyUser
 from services.util import BackendError
 from services.events import (subscribe, REQUEST_STARTS, REQUEST_ENDS,
                              unsubscribe, APP_ENDS)
 from services.wsgiauth import Authentication
 from services.tests.support import make_request
 
-from webob.exc import HTTPUnauthorized, HTTPServiceUnavailable, HTTPNotFound
+from webob.exc import (HTTPUnauthorized, HTTPServiceUnavailable, HTTPNotFound,
+                       HTTPBadRequest)
 
 
 class _Foo(object):
@@ -74,6 +80,12 @@ class _Foo(object):
     def missing(self, request):
         raise HTTPNotFound(request)
 
+    def params(self, request, **params):
+        return ','.join(sorted(params))
+
+    def attrs(self, request):
+        return '%(mail)s %(syncNode)s' % request.user
+
 
 class Mod1(object):
     pass
@@ -95,7 +107,8 @@ class TestBaseApp(unittest.TestCase):
             ('GET', '/missing', 'foo', 'missing'),
             ('GET', '/boom', 'foo', 'boom'),
             ('GET', '/boom2', 'foo', 'boom2'),
-            ('GET', '/boom3', 'foo', 'boom3')]
+            ('GET', '/boom3', 'foo', 'boom3'),
+            ('GET', '/params', 'foo', 'params')]
     controllers = {'foo': _Foo}
     config = {'host:here.one.two': 1,
               'one.two': 2,
@@ -246,6 +259,35 @@ class TestBaseApp(unittest.TestCase):
         self.assertEqual(res.status_int, 200)
         self.assertTrue("DEEBOOG" in res.body)
 
+    def test_heartbeat_health(self):
+        config = {'global.heartbeat_page': '__heartbeat__',
+                  'auth.backend': 'services.auth.dummy.DummyAuth',
+                  'health.enabled': True,
+                  'health.interval': 60}
+        app = SyncServerApp([], {}, config, auth_class=self.auth_class)
+        backends = {'db': lambda: None}
+        app.health = HealthChecker(interval=60, backends=backends)
+        app.health.stop()
+
+        # the heartbeat doesn't wait for the first check
+        request = make_request("/__heartbeat__")
+        self.assertEqual(app(request).status_int, 200)
+        app.health.check()
+
+        # details are returned as json
+        request = make_request("/__heartbeat__?details=1")
+        status = json.loads(app(request).body)
+        self.assertTrue(status['ok'])
+        self.assertTrue(status['backends']['db']['ok'])
+
+        # a failing backend makes the heartbeat fail
+        def _down():
+            raise BackendError('down')
+        backends['db'] = _down
+        app.health.check()
+        request = make_request("/__heartbeat__")
+        self.assertRaises(HTTPServiceUnavailable, app, request)
+
     def test_user(self):
         # the debug page returns a the right username in the body
         request = make_request("/user/testuser")
@@ -261,10 +303,71 @@ class TestBaseApp(unittest.TestCase):
         # this one has a match, will raise from below the auth handler
         request = make_request("/missing")
         self.assertRaises(HTTPNotFound, self.app, request)
+        self.assertEqual(self.app.unrouted_requests, 1)
+
+        # paths that can't match are rejected before routing
+        mapper = self.app.mapper
+        self.app.mapper = None
+        try:
+            for path in ('/nonexistent', '/users/bob', '/usertest'):
+                request = make_request(path)
+                self.assertEqual(self.app(request).status_int, 404)
+        finally:
+            self.app.mapper = mapper
+        self.assertEqual(self.app.unrouted_requests, 4)
+
+        # but not the ones that look like a template
+        request = make_request("/user/bob/other")
+        self.assertEqual(self.app(request).status_int, 404)
+
+    def test_route_requirements(self):
+        # requirements passed in the extras are honored before routing
+        urls = self.urls + [('GET', '/{path}.secret', 'foo', 'secret',
+                             {'requirements': {'path': '.+'}})]
+        app = SyncServerApp(urls, self.controllers, self.config,
+                            auth_class=self.auth_class)
+        request = make_request("/some/where.secret")
+        self.assertEqual(app(request).body, 'here')
+        self.assertEqual(app.unrouted_requests, 0)
+
+    def test_route_user_attrs(self):
+        queries = []
+
+        class Backend(object):
+            def get_user_info(self, user, attrs):
+                queries.append(sorted(attrs))
+                for attr in attrs:
+                    user[attr] = attr.upper()
+
+        urls = self.urls + [('GET', '/attrs', 'foo', 'attrs',
+                             {'user_attrs': ['mail', 'syncNode']})]
+        app = SyncServerApp(urls, self.controllers, self.config,
+                            auth_class=self.auth_class)
+
+        # the attributes listed by the route come in a single query
+        request = make_request("/attrs")
+        request.user = LazyUser(Backend(), 'bob')
+        self.assertEqual(app(request).body, 'MAIL SYNCNODE')
+        self.assertEqual(queries, [['mail', 'syncNode']])
+
+    def test_dispatch_table(self):
+        # actions are resolved once, to their wrapped version
+        function, accepts_params = self.app.actions['foo', 'user']
+        self.assertEqual(function, self.app.controllers['foo']._user_wrapped)
+        self.assertFalse(accepts_params)
+        self.assertTrue(self.app.actions['foo', 'params'][1])
+
+        # the query string is only passed to the actions taking params
+        res = self.app(make_request("/params?b=1&a=2"))
+        self.assertEqual(res.body, 'a,b')
+        res = self.app(make_request("/user/testuser?b=1"))
+        self.assertEqual(res.body, '|testuser|')
 
     def test_methodnotallowed(self):
         request = make_request("/", method="OST")
         self.assertEquals(self.app(request).status, "405 Method Not Allowed")
+        request = make_request("/user/bob", method="PUT")
+        self.assertEquals(self.app(request).status, "405 Method Not Allowed")
 
     def test_events(self):
 
@@ -328,35 +431,39 @@ class TestBaseApp(unittest.TestCase):
             request = make_request("/__heartbeat__")
             app(request)
 
-            # let's "kill it" in a thread
-            class Killer(threading.Thread):
-                def __init__(self, app):
-                    threading.Thread.__init__(self)
-                    self.app = app
+            # a request is being processed
+            app.in_flight += 1
 
-                def run(self):
-                    self.app._sigterm(None, None)
-
-            killer = Killer(app)
-            killer.start()
-            sleep(0.2)
+            # let's "kill it": the handler returns right away and the app
+            # is drained in the background
+            exits = []
+            app._exit = exits.append
+            app._sigterm(15, None)
+            drainer = app._drainer
 
             # in the meantime, /heartbeat should return a 503
             request = make_request("/__heartbeat__")
             self.assertRaises(HTTPServiceUnavailable, app, request)
 
-            # but regular requests should still work
+            # and new requests too
             request = make_request("/")
-            app(request)
+            self.assertRaises(HTTPServiceUnavailable, app, request)
 
-            # sleeping
-            sleep(1.)
+            # the app waits for the request in flight
+            sleep(0.2)
+            self.assertTrue(drainer.is_alive())
+            self.assertEquals(pings, [])
+            self.assertEquals(exits, [])
 
-            # now / should 503 too
-            request = make_request("/")
-            self.assertRaises(HTTPServiceUnavailable, app, request)
+            # a second signal does not start another drain
+            app._sigterm(15, None)
+            app.in_flight -= 1
+            drainer.join(1.)
+            self.assertFalse(drainer.is_alive())
+            self.assertEquals(exits, [15])
 
-            killer.join()
+            # the signal sent again exits the process
+            self.assertRaises(SystemExit, app._sigterm, 15, None)
 
         finally:
             unsubscribe(APP_ENDS, end)
@@ -364,6 +471,23 @@ class TestBaseApp(unittest.TestCase):
         # and we should have had a event ping
         self.assertEquals(pings, ['app ends'])
 
+    def test_drain_deadline(self):
+        config = {'auth.backend': 'services.auth.dummy.DummyAuth',
+                  'global.graceful_shutdown_interval': 0.1,
+                  'global.hard_shutdown_interval': 0.1}
+        app = SyncServerApp([], {}, config, auth_class=self.auth_class)
+
+        # an idle app is drained right away
+        start = time.time()
+        app.drain()
+        self.assertTrue(time.time() - start < 0.1)
+
+        # a stuck request does not delay the shutdown for ever
+        app.in_flight += 1
+        start = time.time()
+        app.drain()
+        self.assertTrue(0.2 <= time.time() - start < 1)
+
     def test_nosigclean(self):
         # check that we can deactivate sigterm/sigint hooks
         pings = []
@@ -393,6 +517,144 @@ class TestBaseApp(unittest.TestCase):
         # and we should have had no ping
         self.assertEquals(pings, [])
 
+    def test_admission(self):
+        config = {'global.heartbeat_page': '__heartbeat__',
+                  'global.debug_page': '__debug__',
+                  'auth.backend': 'services.auth.dummy.DummyAuth',
+                  'admission.enabled': True,
+                  'admission.initial_concurrency': 10,
+                  'admission.retry_after': 3,
+                  'admission.foo.initial_concurrency': 1,
+                  'admission.foo.adaptive': False}
+        app = SyncServerApp(self.urls, self.controllers, config,
+                            auth_class=self.auth_class)
+
+        request = make_request("/user/testuser")
+        self.assertEqual(app(request).status_int, 200)
+
+        # the "foo" controller can only process one request at a time
+        app.controller_admission['foo'].acquire()
+        request = make_request("/user/testuser")
+        try:
+            app(request)
+        except HTTPServiceUnavailable, error:
+            self.assertEqual(error.headers['Retry-After'], '3')
+        else:
+            raise AssertionError('Should raise')
+
+        # the heartbeat is never shed
+        request = make_request("/__heartbeat__")
+        self.assertEqual(app(request).status_int, 200)
+
+        # rejected requests show up on the debug page
+        request = make_request("/__debug__")
+        self.assertTrue("'rejected': 1" in app(request).body)
+        self.assertEqual(app.admission.in_flight, 0)
+
+    def test_priority_lane(self):
+        config = {'global.heartbeat_page': '__heartbeat__',
+                  'auth.backend': 'services.auth.dummy.DummyAuth',
+                  'admission.enabled': True,
+                  'admission.initial_concurrency': 1,
+                  'admission.reserved_concurrency': 1}
+        urls = self.urls + [('GET', '/admin', 'foo', 'secret',
+                             {'priority': True})]
+        app = SyncServerApp(urls, self.controllers, config,
+                            auth_class=self.auth_class)
+
+        # user traffic saturates the server
+        app.admission.acquire()
+        request = make_request("/user/testuser")
+        self.assertRaises(HTTPServiceUnavailable, app, request)
+
+        # but the heartbeat and priority routes have their own lane
+        request = make_request("/__heartbeat__")
+        self.assertEqual(app(request).status_int, 200)
+        request = make_request("/admin")
+        self.assertEqual(app(request).body, 'here')
+        self.assertEqual(app.reserved_lane.in_flight, 0)
+
+        # the heartbeat goes through no lane at all
+        app.reserved_lane.acquire()
+        self.assertRaises(HTTPServiceUnavailable, app, request)
+        request = make_request("/__heartbeat__")
+        self.assertEqual(app(request).status_int, 200)
+
+    def test_metrics_page(self):
+        config = dict(self.config)
+        config['global.metrics_page'] = '__metrics__'
+        app = SyncServerApp(self.urls, self.controllers, config,
+                            auth_class=self.auth_class)
+        for i in range(3):
+            app(make_request("/user/testuser"))
+
+        routes = json.loads(app(make_request("/__metrics__")).body)
+        routes = dict((route['action'], route) for route in routes)
+        self.assertEqual(routes['user']['count'], 3)
+        self.assertEqual(routes['index']['count'], 0)
+        self.assertTrue(routes['user']['p50'] <= routes['user']['max'])
+
+        request = make_request("/__metrics__?format=prometheus")
+        body = app(request).body
+        self.assertTrue('# TYPE services_request_latency_seconds summary'
+                        in body)
+        self.assertTrue('services_request_latency_seconds_count'
+                        '{controller="foo",action="user"} 3' in body)
+        self.assertTrue('action="user",quantile="0.99"}' in body)
+        self.assertTrue('services_unrouted_requests_total 0' in body)
+
+        # a POST resets the histograms
+        app(make_request("/__metrics__", method='POST'))
+        routes = json.loads(app(make_request("/__metrics__")).body)
+        self.assertEqual(sum([route['count'] for route in routes]), 0)
+
+    def test_profile_page(self):
+        config = dict(self.config)
+        config['global.profile_page'] = '__profile__'
+        config['global.profile_max_seconds'] = '0.1'
+        app = SyncServerApp(self.urls, self.controllers, config,
+                            auth_class=self.auth_class)
+        profiler = get_profiler()
+        app(make_request("/__profile__?action=start", method='POST'))
+        try:
+            self.assertTrue(profiler.running)
+        finally:
+            app(make_request("/__profile__?action=stop", method='POST'))
+        self.assertFalse(profiler.running)
+
+        request = make_request("/__profile__?action=explode", method='POST')
+        self.assertRaises(HTTPBadRequest, app, request)
+
+        res = app(make_request("/__profile__?seconds=0.1"))
+        self.assertEqual(res.content_type, 'text/plain')
+        self.assertFalse(profiler.running)
+
+        # the duration is clamped to the configured maximum
+        start = time.time()
+        app(make_request("/__profile__?seconds=3600"))
+        self.assertTrue(time.time() - start < 1)
+
+        for seconds in ('0', '-1', 'nan', 'soon'):
+            request = make_request("/__profile__?seconds=%s" % seconds)
+            self.assertRaises(HTTPBadRequest, app, request)
+
+        # the profiler can't be started outside of the main thread
+        statuses = []
+
+        def _start():
+            request = make_request("/__profile__?action=start",
+                                   method='POST')
+            try:
+                app(request)
+            except HTTPServiceUnavailable:
+                statuses.append(503)
+
+        thread = threading.Thread(target=_start)
+        thread.start()
+        thread.join()
+        self.assertEqual(statuses, [503])
+        self.assertFalse(profiler.running)
+
     def test_modules_loaded(self):
         mod1 = self.app.modules['mod1']
         mod2 = self.app.modules['mod2']
@@ -0,0 +1,88 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from greenlet import greenlet
+
+from services.context import (request_context, get_context,
+                              get_context_value, _STACKS)
+
+
+class TestContext(unittest.TestCase):
+
+    def test_nesting(self):
+        self.assertEqual(get_context(), None)
+        self.assertEqual(get_context_value('one', 'default'), 'default')
+
+        with request_context(one=1, two=2) as outer:
+            self.assertTrue(get_context() is outer)
+            with request_context(one='one') as inner:
+                self.assertTrue(get_context() is inner)
+                self.assertEqual(get_context_value('one'), 'one')
+                self.assertEqual(get_context_value('two'), 2)
+            self.assertTrue(get_context() is outer)
+            self.assertEqual(get_context_value('one'), 1)
+
+        self.assertEqual(get_context(), None)
+        self.assertEqual(_STACKS, {})
+
+    def test_greenlets(self):
+        seen = []
+
+        def _run(value):
+            with request_context(value=value):
+                seen.append(get_context_value('value'))
+                main.switch()
+                seen.append(get_context_value('value'))
+
+        main = greenlet.getcurrent()
+        one = greenlet(_run)
+        two = greenlet(_run)
+        one.switch(1)
+        two.switch(2)
+        self.assertEqual(get_context(), None)
+        one.switch()
+        two.switch()
+        self.assertEqual(seen, [1, 2, 1, 2])
+        self.assertEqual(_STACKS, {})
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestContext))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -34,7 +34,13 @@
 #
 # ***** END LICENSE BLOCK *****
 import unittest
-from services.events import subscribe, notify, unsubscribe
+import gc
+import threading
+
+from services import events
+from services.events import (subscribe, notify, unsubscribe,
+                             set_timing_callback, configure_async,
+                             flush_async, get_async_dropped, APP_ENDS)
 
 
 class TestEvents(unittest.TestCase):
@@ -59,6 +65,174 @@ class TestEvents(unittest.TestCase):
         notify('yo', stuff)
         self.assertEquals(stuff, ['alice', 'bob', 'bob'])
 
+        unsubscribe('yo', bob)
+        notify('yo', stuff)
+        self.assertEquals(stuff, ['alice', 'bob', 'bob'])
+
+    def test_unsubscribe_during_notify(self):
+        stuff = []
+
+        def alice(data):
+            data.append('alice')
+            unsubscribe('yo', alice)
+            unsubscribe('yo', bob)
+
+        def bob(data):
+            data.append('bob')
+
+        subscribe('yo', alice)
+        subscribe('yo', bob)
+        # the subscribers are the ones at the time of the notification
+        notify('yo', stuff)
+        self.assertEquals(stuff, ['alice', 'bob'])
+        notify('yo', stuff)
+        self.assertEquals(stuff, ['alice', 'bob'])
+
+    def test_timing(self):
+        timings = []
+
+        def callback(event, func, duration):
+            timings.append((event, func, duration))
+
+        def alice():
+            pass
+
+        subscribe('yo', alice)
+        set_timing_callback(callback)
+        try:
+            notify('yo')
+            notify('nobody-listens')
+        finally:
+            set_timing_callback(None)
+            unsubscribe('yo', alice)
+        self.assertEquals(len(timings), 1)
+        event, func, duration = timings[0]
+        self.assertEquals((event, func), ('yo', alice))
+        self.assertTrue(duration >= 0)
+
+    def test_async(self):
+        stuff = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(data):
+            started.set()
+            release.wait(5)
+            stuff.append(data)
+
+        configure_async(max_size=2)
+        subscribe('yo', slow, asynchronous=True)
+        try:
+            notify('yo', 1)
+            started.wait(5)
+            # the worker is busy with 1, 2 and 3 are queued, 4 is dropped
+            notify('yo', 2)
+            notify('yo', 3)
+            notify('yo', 4)
+            self.assertEquals(stuff, [])
+            self.assertEquals(get_async_dropped(), {'yo': 1})
+            release.set()
+            self.assertTrue(flush_async())
+            self.assertEquals(stuff, [1, 2, 3])
+
+            # async subscribers can be unsubscribed like the others
+            unsubscribe('yo', slow)
+            notify('yo', 5)
+            self.assertTrue(flush_async())
+            self.assertEquals(stuff, [1, 2, 3])
+        finally:
+            unsubscribe('yo', slow)
+            configure_async()
+
+    def test_async_reconfigured(self):
+        configure_async()
+        subscribe('yo', list, asynchronous=True)
+        try:
+            notify('yo')
+            worker = events._dispatcher._worker
+            self.assertTrue(worker.is_alive())
+
+            # the worker of the replaced queue goes away
+            configure_async()
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        finally:
+            unsubscribe('yo', list)
+            configure_async()
+
+    def test_async_drop_oldest(self):
+        stuff = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(data):
+            started.set()
+            release.wait(5)
+            stuff.append(data)
+
+        configure_async(max_size=2, drop_policy='oldest')
+        subscribe('yo', slow, asynchronous=True)
+        try:
+            notify('yo', 1)
+            started.wait(5)
+            for data in (2, 3, 4):
+                notify('yo', data)
+            self.assertEquals(get_async_dropped(), {'yo': 1})
+            release.set()
+            # APP_ENDS flushes the queue
+            notify(APP_ENDS)
+            self.assertEquals(stuff, [1, 3, 4])
+        finally:
+            unsubscribe('yo', slow)
+            configure_async()
+
+    def test_weak(self):
+        calls = []
+
+        class Pool(object):
+            def close(self):
+                calls.append(self)
+
+        pool = Pool()
+        subscribe('yo', pool.close, weak=True)
+        try:
+            notify('yo')
+            self.assertEquals(calls, [pool])
+
+            # a weak subscriber is unsubscribed like any other
+            unsubscribe('yo', pool.close)
+            notify('yo')
+            self.assertEquals(len(calls), 1)
+
+            # and the subscription does not keep the object alive
+            subscribe('yo', pool.close, weak=True)
+            del pool, calls[:]
+            gc.collect()
+            notify('yo')
+            self.assertEquals(calls, [])
+            self.assertFalse('yo' in events._events)
+        finally:
+            events._events.pop('yo', None)
+
+    def test_weak_collected_under_lock(self):
+        class Pool(object):
+            def close(self):
+                pass
+
+        pool = Pool()
+        pool.cycle = pool
+        subscribe('yo', pool.close, weak=True)
+        try:
+            # the collector may run while the registry is locked
+            del pool
+            with events._lock:
+                gc.collect()
+            self.assertTrue('yo' in events._events)
+            notify('yo')
+            self.assertFalse('yo' in events._events)
+        finally:
+            events._events.pop('yo', None)
+
 
 def test_suite():
     suite = unittest.TestSuite()
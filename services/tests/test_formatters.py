@@ -39,9 +39,12 @@ import unittest
 
 from webob import Request
 
+from services import formatters
 from services.formatters import (json_response, newlines_response,
                                 whoisi_response, text_response,
-                                convert_response)
+                                convert_response, stream_json_response,
+                                stream_newlines_response,
+                                stream_whoisi_response)
 
 
 class TestFormatters(unittest.TestCase):
@@ -84,3 +87,63 @@ class TestFormatters(unittest.TestCase):
         resp = convert_response(request, data)
         self.assertEquals(resp.body, '{"some": "data"}')
         self.assertEquals(resp.content_type, 'application/json')
+
+    def test_batched(self):
+        chunks = ['a', 'b', 'c', 'd', 'e']
+        self.assertEquals(list(formatters._batched(chunks, 2)),
+                          ['ab', 'cd', 'e'])
+        self.assertEquals(list(formatters._batched(chunks, 5)), ['abcde'])
+        self.assertEquals(list(formatters._batched([], 2)), [])
+
+    def test_streaming(self):
+        formats = ((json_response, stream_json_response),
+                   (newlines_response, stream_newlines_response),
+                   (whoisi_response, stream_whoisi_response))
+        datasets = ([], ['one'], [{'id': i, 'text': u'\xe9\n'}
+                                  for i in range(250)])
+
+        # streamed bodies are identical to the buffered ones
+        for buffered, streamed in formats:
+            for data in datasets:
+                expected = buffered(data)
+                for batch_size in (1, 7, 100):
+                    resp = streamed(iter(data), batch_size=batch_size)
+                    self.assertEquals(''.join(resp.app_iter), expected.body)
+                    self.assertEquals(resp.content_type,
+                                      expected.content_type)
+        resp = stream_json_response({'some': 'data'})
+        self.assertEquals(''.join(resp.app_iter), '{"some": "data"}')
+
+        # convert_response streams above the threshold, or for iterators
+        # when asked to
+        accepts = ('application/json', 'application/newlines',
+                   'application/whoisi')
+        for accept, (buffered, streamed) in zip(accepts, formats):
+            request = Request({})
+            request.accept = accept
+            for size in (formatters.STREAMING_THRESHOLD,
+                         formatters.STREAMING_THRESHOLD + 1):
+                data = range(size)
+                expected = buffered(data).body
+                resp = convert_response(request, data)
+                is_streamed = not isinstance(resp.app_iter, list)
+                self.assertEquals(is_streamed,
+                                  size > formatters.STREAMING_THRESHOLD)
+                self.assertEquals(''.join(resp.app_iter), expected)
+
+            resp = convert_response(request, iter(range(3)))
+            self.assertTrue(isinstance(resp.app_iter, list))
+            self.assertEquals(resp.body, buffered(range(3)).body)
+
+            # so errors raised by the iterator reach the app
+            def failing():
+                yield 1
+                raise ValueError()
+
+            self.assertRaises(ValueError, convert_response, request,
+                              failing())
+
+            resp = convert_response(request, iter(range(3)), stream=True)
+            self.assertFalse(isinstance(resp.app_iter, list))
+            self.assertEquals(''.join(resp.app_iter),
+                              buffered(range(3)).body)
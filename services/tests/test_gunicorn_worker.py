@@ -0,0 +1,142 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import sys
+import time
+import unittest
+import traceback
+
+import gevent
+import greenlet
+
+from services import gunicorn_worker
+from services.gunicorn_worker import BlockingStats, MozSvcWorker
+
+
+def _blocking_call():
+    return sys._getframe()
+
+
+def _other_blocking_call():
+    return sys._getframe()
+
+
+def _block_the_hub(duration):
+    time.sleep(duration)
+
+
+class TestBlockingStats(unittest.TestCase):
+
+    def test_summary(self):
+        stats = BlockingStats()
+        one = greenlet.greenlet(lambda: None)
+        two = greenlet.greenlet(lambda: None)
+
+        for duration, func, glet in ((.2, _blocking_call, one),
+                                     (.3, _blocking_call, two),
+                                     (.5, _blocking_call, one),
+                                     (.1, _other_blocking_call, two)):
+            frame = func()
+            stats.record(duration, stats.get_stack_key(frame),
+                         traceback.format_stack(frame), glet)
+
+        # the stacks are deduped
+        self.assertEqual(len(stats.stacks), 2)
+        self.assertEqual(stats.durations.count, 4)
+        self.assertEqual(stats.greenlets[one], 500)
+        self.assertEqual(stats.greenlets[two], 300)
+
+        summary = stats.get_summary(size=1)
+        self.assertTrue('blocked 4 times' in summary)
+        self.assertTrue('3 times, 1000ms in total, 500ms max' in summary)
+        self.assertTrue('_blocking_call' in summary)
+        self.assertFalse('_other_blocking_call' in summary)
+        self.assertTrue('500ms: %r' % one in summary)
+
+        # dead greenlets are forgotten
+        del one
+        self.assertEqual(len(stats.greenlets), 1)
+
+
+class TestBlockingMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self._old = (gunicorn_worker.MAX_BLOCKING_TIME,
+                     gunicorn_worker.MAX_BLOCKING_EPISODE)
+        gunicorn_worker.MAX_BLOCKING_TIME = .05
+        gunicorn_worker.MAX_BLOCKING_EPISODE = .2
+        # the worker is not initialized, we only need the monitor
+        self.worker = MozSvcWorker.__new__(MozSvcWorker)
+        self.errors = []
+        self.worker._log_error = self.errors.append
+
+    def tearDown(self):
+        heartbeat = getattr(self.worker, '_heartbeat', None)
+        if heartbeat is not None:
+            heartbeat.stop()
+            # let the monitoring thread see it and exit
+            time.sleep(.1)
+        (gunicorn_worker.MAX_BLOCKING_TIME,
+         gunicorn_worker.MAX_BLOCKING_EPISODE) = self._old
+
+    def test_blocking_episode(self):
+        self.worker._start_blocking_monitor()
+        gevent.sleep(.2)
+        self.assertEqual(len(self.worker._blocking_stats.stacks), 0)
+
+        # a greenlet blocks the hub, and the episode is logged while it
+        # is still in progress
+        glet = gevent.spawn(_block_the_hub, .5)
+        glet.join()
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue('blocked for' in self.errors[0])
+        self.assertTrue('_block_the_hub' in self.errors[0])
+
+        # it is recorded once the loop ticks again
+        gevent.sleep(.2)
+        stats = self.worker._blocking_stats
+        self.assertEqual(stats.durations.count, 1)
+        entry, = stats.stacks.values()
+        self.assertTrue(entry['max'] >= 400)
+        self.assertTrue('_block_the_hub' in "".join(entry['stack']))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBlockingStats))
+    suite.addTest(unittest.makeSuite(TestBlockingMonitor))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
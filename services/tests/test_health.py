@@ -0,0 +1,164 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import gc
+import time
+
+from services import events
+from services.events import APP_ENDS
+from services.health import (HealthChecker, register_backend,
+                             unregister_backend, get_backends)
+from services.exceptions import BackendError
+
+
+def _ok():
+    pass
+
+
+def _down():
+    raise BackendError('down')
+
+
+def _hanging():
+    time.sleep(1)
+
+
+def _get_checked_status(checker):
+    # waits for the first check, done in the background
+    deadline = time.time() + 5
+    status = checker.get_status()
+    while status.get('pending') and time.time() < deadline:
+        time.sleep(.01)
+        status = checker.get_status()
+    return status
+
+
+class TestHealthChecker(unittest.TestCase):
+
+    def test_check(self):
+        backends = {'one': _ok, 'two': _ok}
+        checker = HealthChecker(interval=60, backends=backends)
+        try:
+            status = _get_checked_status(checker)
+            self.assertTrue(status['ok'])
+            self.assertTrue(status['backends']['one']['ok'])
+            self.assertTrue(status['backends']['two']['latency'] >= 0)
+
+            # the status is cached until the next check
+            backends['two'] = _down
+            self.assertTrue(checker.get_status() is status)
+            status = checker.check()
+            self.assertFalse(status['ok'])
+            self.assertTrue(status['backends']['one']['ok'])
+            self.assertFalse(status['backends']['two']['ok'])
+            self.assertTrue('down' in status['backends']['two']['error'])
+        finally:
+            checker.stop()
+
+    def test_first_check(self):
+        checker = HealthChecker(interval=60, backends={'slow': _hanging})
+        try:
+            # the first status doesn't wait for the backends
+            start = time.time()
+            status = checker.get_status()
+            self.assertTrue(time.time() - start < .5)
+            self.assertTrue(status['ok'])
+            self.assertTrue(status['pending'])
+        finally:
+            checker.stop()
+
+    def test_stop(self):
+        checker = HealthChecker(interval=60, backends={'one': _ok})
+        self.assertTrue(checker.stop in events._events[APP_ENDS])
+        _get_checked_status(checker)
+        checker.stop()
+        checker._checker.join(5)
+        self.assertFalse(checker._checker.is_alive())
+
+    def test_timeout(self):
+        checker = HealthChecker(timeout=.1, backends={'slow': _hanging})
+        status = checker.check()
+        self.assertFalse(status['ok'])
+        self.assertEqual(status['backends']['slow']['error'], 'timed out')
+
+        # the hanging probe is not started again
+        status = checker.check()
+        self.assertEqual(status['backends']['slow']['error'],
+                         'previous check still running')
+
+    def test_outdated(self):
+        checker = HealthChecker(interval=60, max_age=.1,
+                                backends={'one': _ok})
+        try:
+            self.assertTrue(_get_checked_status(checker)['ok'])
+            time.sleep(.2)
+            status = checker.get_status()
+            self.assertFalse(status['ok'])
+            self.assertEqual(status['error'], 'status is outdated')
+        finally:
+            checker.stop()
+
+    def test_registry(self):
+
+        class Backend(object):
+            def check_health(self):
+                raise BackendError('down')
+
+        backend = Backend()
+        register_backend('test:func', _ok)
+        register_backend('test:method', backend.check_health)
+        try:
+            checker = HealthChecker(interval=60)
+            status = checker.check()['backends']
+            self.assertTrue(status['test:func']['ok'])
+            self.assertFalse(status['test:method']['ok'])
+
+            # the registry does not keep the backends alive
+            del backend
+            gc.collect()
+            self.assertTrue('test:func' in get_backends())
+            self.assertFalse('test:method' in get_backends())
+        finally:
+            unregister_backend('test:func')
+            unregister_backend('test:method')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestHealthChecker))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -39,6 +39,8 @@ import unittest
 import urllib2
 import socket
 from services.http_helpers import get_url, proxy
+from services.exceptions import CircuitOpenError, BackendTimeoutError
+from services.util import configure_circuit_breakers, request_deadline
 
 
 class FakeResult(object):
@@ -77,6 +79,10 @@ class TestHttp(unittest.TestCase):
             raise urllib2.URLError(socket.timeout())
         if url == 'http://error':
             raise urllib2.HTTPError(url, 500, 'Error', {}, None)
+        if url == 'http://unavailable':
+            raise urllib2.HTTPError(url, 503, 'Unavailable', {}, None)
+        if url == 'http://broken':
+            raise socket.error('connection reset')
         if url == 'http://newplace':
             res = FakeResult()
             res.body = url + ' ' + req.headers['Authorization']
@@ -127,6 +133,43 @@ class TestHttp(unittest.TestCase):
         code, headers, body = get_url('http://error', get_body=False)
         self.assertEquals(code, 500)
 
+    def test_circuit_breaker(self):
+        configure_circuit_breakers(min_calls=3, cooldown=60)
+        try:
+            for i in range(3):
+                code, headers, body = get_url('http://timeout', timeout=0.1)
+                self.assertEquals(code, 504)
+
+            # the server is now considered down, we don't even try
+            try:
+                get_url('http://timeout', timeout=0.1)
+            except CircuitOpenError, err:
+                self.assertEquals(err.retry_after, 60)
+            else:
+                raise AssertionError('Should raise')
+
+            # other servers are not affected
+            code, headers, body = get_url('http://google.com')
+            self.assertEquals(code, 200)
+
+            # the statuses sent by the server are not failures
+            for i in range(5):
+                code, headers, body = get_url('http://unavailable')
+                self.assertEquals(code, 503)
+
+            # but the errors escaping are
+            for i in range(3):
+                self.assertRaises(socket.error, get_url, 'http://broken')
+            self.assertRaises(CircuitOpenError, get_url, 'http://broken')
+        finally:
+            configure_circuit_breakers()
+
+    def test_deadline(self):
+        # the call is not even attempted once the deadline is passed
+        with request_deadline(-1):
+            self.assertRaises(BackendTimeoutError, get_url,
+                              'http://google.com')
+
     def test_proxy(self):
         class FakeRequest(object):
             url = 'http://locahost'
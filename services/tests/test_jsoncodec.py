@@ -0,0 +1,90 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+from decimal import Decimal
+
+from services import jsoncodec
+from services.util import round_time
+
+
+class TestJSONCodec(unittest.TestCase):
+
+    def tearDown(self):
+        jsoncodec.set_codec()
+
+    def test_codecs(self):
+        data = {'modified': round_time(1325192345.123), 'id': u'\xe9t\xe9',
+                'items': [1, 2.5, None, True]}
+        for name in ('json', 'simplejson'):
+            jsoncodec.set_codec(name)
+            self.assertEqual(jsoncodec.codec_name, name)
+            encoded = jsoncodec.dumps(data)
+            decoded = jsoncodec.loads(encoded)
+            self.assertEqual(decoded['id'], data['id'])
+            self.assertEqual(decoded['items'], data['items'])
+            self.assertEqual(Decimal(str(decoded['modified'])),
+                             data['modified'])
+            self.assertRaises(TypeError, jsoncodec.dumps, object())
+
+        # decimals are written as they are
+        self.assertEqual(jsoncodec.dumps(Decimal('12.30')), '12.30')
+        self.assertRaises(ValueError, jsoncodec.set_codec, 'xml')
+
+    def test_exact_decimals(self):
+        data = [Decimal('12.30'), round_time(1325192345.1),
+                {'modified': Decimal('-0.000001'), 'ttl': Decimal('1E+3')}]
+        outputs = []
+        for name in ('json', 'simplejson'):
+            jsoncodec.set_codec(name)
+            outputs.append(jsoncodec.dumps(data))
+            self.assertEqual(jsoncodec.dumps(Decimal('12.30')), '12.30')
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue('1325192345.10' in outputs[0])
+
+    def test_fastest(self):
+        jsoncodec.set_codec()
+        if jsoncodec._HAS_SPEEDUPS:
+            self.assertEqual(jsoncodec.codec_name, 'simplejson')
+        else:
+            self.assertEqual(jsoncodec.codec_name, 'json')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestJSONCodec))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -36,6 +36,8 @@
 import unittest
 import threading
 import time
+
+from services.util import get_circuit_breaker
 try:
     import ldap
     from services.ldappool import ConnectionManager, StateConnector
@@ -194,6 +196,10 @@ class TestLDAPSQLAuth(unittest.TestCase):
         finally:
             worker1.join()
 
+        # and the breaker of the server gets the outcome of the call
+        breaker = get_circuit_breaker('ldap://localhost')
+        self.assertTrue(breaker._calls[-1][1])
+
         # we still have one active connector
         self.assertEqual(len(pool), 1)
 
@@ -0,0 +1,87 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from services.config import Config
+from services.memory import MemoryProfiler, register_cache, get_cache_sizes
+
+
+class _Leaky(object):
+    pass
+
+
+class _Cache(object):
+    def __init__(self, size):
+        self.items = range(size)
+
+
+class TestMemoryProfiler(unittest.TestCase):
+
+    def test_report(self):
+        profiler = MemoryProfiler(batch_size=100)
+        report = profiler.get_report()
+        self.assertTrue('Most common types' in report)
+
+        leaked = [_Leaky() for i in range(1000)]
+        report = profiler.get_report()
+        self.assertTrue('Top growing types' in report)
+        line = [line for line in report.splitlines() if '_Leaky' in line][0]
+        self.assertTrue(line.split()[0] in ('+1000', '+1001'), line)
+        self.assertTrue('services.tests.test_memory._Leaky' in line)
+        del leaked
+
+    def test_caches(self):
+        one, two = _Cache(2), _Cache(3)
+        register_cache('test.cache', one, lambda cache: len(cache.items))
+        register_cache('test.cache', two, lambda cache: len(cache.items))
+        self.assertEqual(get_cache_sizes()['test.cache'], 5)
+        del one
+        self.assertEqual(get_cache_sizes()['test.cache'], 3)
+        del two
+        self.assertFalse('test.cache' in get_cache_sizes())
+
+        config = Config({'one.two': 1})
+        config.merge('one')
+        self.assertTrue(get_cache_sizes()['config.merge_cache'] >= 1)
+        self.assertTrue('config.merge_cache' in MemoryProfiler().get_report())
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMemoryProfiler))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -35,7 +35,16 @@
 # ***** END LICENSE BLOCK *****
 import os.path
 import unittest
-from services.metrics import MetlogLoader
+import simplejson as json
+from metlog.client import MetlogClient
+from metlog.senders.dev import DebugCaptureSender
+from services.metrics import (MetlogLoader, thread_context, backend_timer,
+                              update_metlog_data, MetricsAggregator,
+                              LatencyHistogram,
+                              configure_metrics, send_services_data)
+from services.config import Config
+from services.util import ssha, validate_password
+from services import metrics
 
 
 heredir = os.path.dirname(__file__)
@@ -53,3 +62,129 @@ class TestMetlogPlugin(unittest.TestCase):
         sender = holder.default_client.sender
         self.assertEqual(sender.__class__.__name__, 'DebugCaptureSender')
         self.assertEqual(sender.bindstrs, ['foo', 'bar'])
+
+    def test_backend_timer(self):
+        # outside of a thread context, nothing happens
+        with backend_timer('sql'):
+            pass
+
+        sent = []
+        with thread_context(sent.append) as metlog_data:
+            with backend_timer('sql'):
+                pass
+            with backend_timer('sql'):
+                pass
+            validate_password('one', ssha('one'))
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(metlog_data['sql_count'], 2)
+        self.assertTrue(metlog_data['sql_time'] >= 0)
+        self.assertEqual(metlog_data['password_count'], 1)
+
+    def test_nested_thread_context(self):
+        sent = []
+        with thread_context(sent.append) as outer:
+            update_metlog_data({'one': 1})
+            with thread_context(sent.append) as inner:
+                update_metlog_data({'two': 2})
+            update_metlog_data({'three': 3})
+
+        self.assertEqual(inner, {'two': 2})
+        self.assertEqual(outer, {'one': 1, 'three': 3})
+        self.assertEqual(sent, [inner, outer])
+        self.assertRaises(AttributeError, update_metlog_data, {})
+
+    def test_aggregator(self):
+        sender = DebugCaptureSender()
+        client = MetlogClient(sender, 'test')
+        aggregator = MetricsAggregator(flush_interval=3600, client=client)
+        for elapsed in range(1, 101):
+            aggregator.incr('calls')
+            aggregator.timing('action', elapsed)
+        aggregator.incr('calls', 2)
+
+        # nothing is sent before the flush
+        self.assertEqual(len(sender.msgs), 0)
+        aggregator.flush()
+        msgs = [json.loads(msg) for msg in sender.msgs]
+        self.assertEqual(len(msgs), 2)
+        counter, timer = sorted(msgs, key=lambda msg: msg['type'])
+
+        self.assertEqual(counter['type'], 'counter')
+        self.assertEqual(counter['payload'], '102')
+        self.assertEqual(timer['type'], 'timer_summary')
+        fields = timer['fields']
+        self.assertEqual(fields['name'], 'action')
+        self.assertEqual(fields['count'], 100)
+        self.assertEqual(fields['min'], 1)
+        self.assertEqual(fields['max'], 100)
+        self.assertEqual(fields['mean'], 50.5)
+        self.assertTrue(45 <= fields['p50'] <= 55, fields['p50'])
+        self.assertTrue(85 <= fields['p90'] <= 95, fields['p90'])
+        self.assertTrue(95 <= fields['p99'] <= 100, fields['p99'])
+
+        # the next flush has nothing to send
+        sender.msgs.clear()
+        aggregator.flush()
+        self.assertEqual(len(sender.msgs), 0)
+
+    def test_services_sampling(self):
+        sender = DebugCaptureSender()
+        client = MetlogClient(sender, 'test')
+
+        class FakeRequest(object):
+            user = {'userid': 1}
+
+        @send_services_data(client=client)
+        def action(request):
+            update_metlog_data({'one': 1})
+
+        configure_metrics(services_sample_rate=0.)
+        try:
+            for i in range(10):
+                action(FakeRequest())
+            self.assertEqual(len(sender.msgs), 0)
+        finally:
+            configure_metrics()
+
+        action(FakeRequest())
+        self.assertEqual(len(sender.msgs), 1)
+
+        # the options can come from the config, as strings, along with
+        # options used by something else
+        config = Config({'metrics.services_sample_rate': '0.5',
+                         'metrics.flush_interval': '0.5',
+                         'metrics.aggregate': 'true',
+                         'metrics.statsd_host': 'localhost'})
+        sender.msgs.clear()
+        configure_metrics(**config.get_section('metrics'))
+        try:
+            self.assertEqual(metrics.get_aggregator().flush_interval, 0.5)
+            for i in range(200):
+                action(FakeRequest())
+            self.assertTrue(0 < len(sender.msgs) < 200)
+        finally:
+            configure_metrics()
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(max_value=10 ** 6)
+        self.assertEqual(histogram.get_percentile(99), 0)
+        for value in range(1, 10001):
+            histogram.record(value)
+        histogram.record(10 ** 7)
+
+        # the error is bounded by the precision
+        for percentile in (50, 90, 99):
+            expected = 100 * percentile
+            value = histogram.get_percentile(percentile)
+            self.assertTrue(abs(value - expected) <= expected / 64.,
+                            (percentile, value))
+        summary = histogram.get_summary()
+        self.assertEqual(summary['count'], 10001)
+        self.assertEqual(summary['min'], 1)
+        self.assertEqual(summary['max'], 10 ** 7)
+        self.assertEqual(histogram.get_percentile(100), 10 ** 7)
+
+        histogram.reset()
+        self.assertEqual(histogram.get_summary()['count'], 0)
+        self.assertEqual(histogram.get_percentile(50), 0)
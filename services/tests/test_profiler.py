@@ -0,0 +1,121 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import sys
+import time
+import unittest
+import threading
+
+from services.profiler import SamplingProfiler
+
+
+def _burn(duration):
+    end = time.time() + duration
+    while time.time() < end:
+        sum(range(100))
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def test_sampling(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        try:
+            self.assertTrue(profiler.running)
+            _burn(0.3)
+        finally:
+            profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertTrue(profiler.samples > 0)
+
+        lines = profiler.get_collapsed_stacks().splitlines()
+        total = 0
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            total += int(count)
+        self.assertEqual(total, profiler.samples)
+        self.assertTrue(any(['test_profiler.py' in line and '_burn (' in line
+                             for line in lines]))
+
+        # no more samples once stopped
+        samples = profiler.samples
+        _burn(0.05)
+        self.assertEqual(profiler.samples, samples)
+
+        profiler.reset()
+        self.assertEqual(profiler.samples, 0)
+        self.assertEqual(profiler.get_collapsed_stacks(), '')
+
+    def test_max_stacks(self):
+        profiler = SamplingProfiler(max_stacks=1)
+        frame = sys._getframe()
+        profiler._sample(None, frame)
+        profiler._sample(None, frame.f_back)
+        profiler._sample(None, frame.f_back)
+        lines = profiler.get_collapsed_stacks().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], '(truncated) 2')
+
+    def test_max_frames(self):
+        profiler = SamplingProfiler(max_frames=2)
+        frame = sys._getframe()
+        for i in range(3):
+            profiler._sample(None, frame)
+            self.assertTrue(len(profiler._frame_names) <= 2)
+        self.assertEqual(profiler.samples, 3)
+
+    def test_main_thread_only(self):
+        profiler = SamplingProfiler()
+        errors = []
+
+        def _start():
+            try:
+                profiler.start()
+            except ValueError, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_start)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(profiler.running)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSamplingProfiler))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
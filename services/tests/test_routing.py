@@ -0,0 +1,87 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from services.routing import RouteIndex
+
+
+class TestRouteIndex(unittest.TestCase):
+
+    def test_index(self):
+        index = RouteIndex()
+        index.add('/', ['GET'])
+        index.add('/user/{username}', ['GET'])
+        index.add('/{api:1\.0|1\.1}/{username}/info', ['GET'])
+        index.add('/v{version:\d+}.json', ['GET', 'POST'])
+        index.add('/{path:a.b}', ['GET'])
+
+        for path in ('/', '/user/bob', '/user', '/1.1/bob/info', '/1.0',
+                     '/v2.json', '/v2.json/x', '/a/b', '/', 'relative'):
+            self.assertTrue(index.is_routable(path), path)
+
+        for path in ('/users', '/1.2/bob/info', '/v.json', '/vx.json',
+                     '/a'):
+            self.assertFalse(index.is_routable(path), path)
+
+        self.assertEqual(index.get_methods('/'), set(['GET']))
+        self.assertEqual(index.get_methods('/user/bob'), None)
+
+    def test_requirements(self):
+        index = RouteIndex()
+        index.add('/{a}.json', ['GET'], {'a': '.+'})
+        index.add('/v{version}/info', ['GET'], {'version': '\d+'})
+        index.add('/{b:x+}.txt', ['GET'], {'b': 'y+'})
+
+        for path in ('/a.json', '/a/b.json', '/v12/info', '/xx.txt'):
+            self.assertTrue(index.is_routable(path), path)
+
+        for path in ('/a.jsonx', '/vx/info', '/yy.txt'):
+            self.assertFalse(index.is_routable(path), path)
+
+    def test_old_syntax(self):
+        index = RouteIndex()
+        index.add('/user/{username}', ['GET'])
+        index.add('/:controller/:action', ['GET'])
+        self.assertTrue(index.is_routable('/whatever'))
+        self.assertEqual(index.get_methods('/user/bob'), None)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRouteIndex))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
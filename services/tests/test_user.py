@@ -38,13 +38,14 @@
 import unittest
 import time
 import os
+import contextlib
 
 from nose.plugins.skip import SkipTest
 
 from webob import Response
 from webob.exc import HTTPServiceUnavailable
 
-from services.user import User, extract_username
+from services.user import User, LazyUser, make_user, extract_username
 from services.pluginreg import load_and_configure
 from services.respcodes import ERROR_INVALID_WRITE
 from services.tests.support import CAN_MOCK_WSGI, mock_wsgi
@@ -87,6 +88,54 @@ class Request(object):
         self.environ = environ
 
 
+class _FakeCache(object):
+    """Memcached client and pool, keeping the data in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    @contextlib.contextmanager
+    def reserve(self):
+        yield self
+
+    def get_multi(self, keys):
+        return dict([(key, self.data[key]) for key in keys
+                     if key in self.data])
+
+    def set(self, key, value, ttl):
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class _FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class _FakeProxy(object):
+    """Answers like the whoami API, with `result` as the userid."""
+
+    def __init__(self):
+        self.result = 42
+        self.calls = []
+
+    def authenticate_user(self, user, credentials, attrs=None):
+        self.calls.append(user['username'])
+        if isinstance(self.result, Exception):
+            raise self.result
+        if self.result is not None:
+            user['userid'] = self.result
+            user['syncNode'] = 'blah'
+        return self.result
+
+
 class TestUser(unittest.TestCase):
 
     def _tests(self, mgr):
@@ -420,6 +469,129 @@ class TestUser(unittest.TestCase):
             self.assertEquals(userid, None)
             self.assertTrue(whoami_was_called)
 
+    def test_user_proxycache_stale(self):
+        try:
+            from services.user import proxycache
+        except ImportError:
+            raise SkipTest
+
+        # no memcached and no whoami server, and time is under control
+        config = dict(proxycache_config, cache_timeout='100',
+                      stale_grace='50')
+        mgr = load_and_configure(config)
+        cache = _FakeCache()
+        mgr.cache_pool = cache
+        clock = _FakeClock(1500)
+        mgr.proxy = proxy = _FakeProxy()
+        old_time = proxycache.time
+        proxycache.time = clock
+        try:
+            user = User("test3")
+            self.assertEquals(mgr.authenticate_user(user, "password",
+                                                    ["syncNode"]), 42)
+
+            # Once expired, a failing whoami falls back to the stale entry.
+            clock.now = 1610
+            proxy.result = BackendError()
+            user = User("test3")
+            self.assertEquals(mgr.authenticate_user(user, "password",
+                                                    ["syncNode"]), 42)
+            self.assertEquals(user["syncNode"], "blah")
+            self.assertEquals(len(proxy.calls), 2)
+
+            # But credentials that were never verified still fail.
+            user = User("test4")
+            self.assertRaises(BackendError, mgr.authenticate_user,
+                              user, "password")
+
+            # An entry found under the previous token is refreshed, and
+            # dropped if the credentials were revoked.
+            cache.data.clear()
+            clock.now = 1640
+            proxy.result = 42
+            mgr.authenticate_user(User("test5"), "password")
+            self.assertEquals(len(cache.data), 1)
+            clock.now = 1730
+            proxy.result = None
+            self.assertEquals(mgr.authenticate_user(User("test5"),
+                                                    "password"), 42)
+            deadline = time.time() + 5
+            while mgr._refreshing and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEquals(cache.data, {})
+        finally:
+            proxycache.time = old_time
+
+    def test_lazy_user(self):
+        mgr = load_and_configure(memory_config)
+        mgr.create_user('lazy', u'password', 'lazy@mozilla.com')
+        mgr._users['lazy']['syncNode'] = 'http://node'
+        queries = []
+        get_user_info = mgr.get_user_info
+
+        def _get_user_info(user, attrs):
+            queries.append(sorted(attrs))
+            return get_user_info(user, attrs)
+
+        mgr.get_user_info = _get_user_info
+
+        # attributes loaded while authenticating are not fetched again
+        user = LazyUser(mgr, 'lazy')
+        credentials = {"username": "lazy", "password": "password"}
+        self.assertTrue(mgr.authenticate_user(user, credentials,
+                                              ['syncNode']))
+        self.assertEqual(user['syncNode'], 'http://node')
+        self.assertEqual(queries, [])
+
+        # missing ones are fetched on first access, with the prefetched ones
+        user.prefetch('mail', 'syncNode')
+        self.assertEqual(user['other'], None)
+        self.assertEqual(user['mail'], 'lazy@mozilla.com')
+        self.assertEqual(queries, [['mail', 'other']])
+
+        # get() and "in" never query the backend
+        self.assertEqual(user.get('another'), None)
+        self.assertFalse('another' in user)
+        self.assertEqual(len(queries), 1)
+
+        # attributes are only fetched once
+        self.assertEqual(user['another'], None)
+        self.assertEqual(user['another'], None)
+        self.assertEqual(len(queries), 2)
+
+        # the batches are not shared between users
+        del queries[:]
+        user = LazyUser(mgr, 'lazy')
+        self.assertEqual(user['mail'], 'lazy@mozilla.com')
+        self.assertEqual(queries, [['mail']])
+
+        # old-style or missing backends give plain users
+        self.assertTrue(isinstance(make_user(mgr, 'lazy'), LazyUser))
+        self.assertEqual(type(make_user(None, 'lazy')), User)
+
+    def test_lazy_user_sql(self):
+        try:
+            import sqlalchemy  # NOQA
+        except ImportError:
+            raise SkipTest
+
+        mgr = load_and_configure(sql_config)
+        try:
+            mgr.create_user('lazy', u'password', 'lazy@mozilla.com')
+
+            # unknown attributes raise a KeyError
+            user = LazyUser(mgr, 'lazy')
+            self.assertRaises(KeyError, user.__getitem__, 'unknown')
+            self.assertRaises(KeyError, user.__getitem__, 'unknown')
+
+            # even when batched with known ones
+            user.prefetch('unknown2', 'syncNode')
+            self.assertEqual(user['mail'], 'lazy@mozilla.com')
+            self.assertRaises(KeyError, user.__getitem__, 'unknown2')
+            self.assertEqual(user['syncNode'], None)
+        finally:
+            if os.path.exists(TEMP_DATABASE_FILE):
+                os.unlink(TEMP_DATABASE_FILE)
 
     def test_extract_username(self):
         self.assertEquals(extract_username('username'), 'username')
@@ -41,13 +41,23 @@ import socket
 import StringIO
 import sys
 import warnings
+import copy
+import os
+import pickle
+from decimal import Decimal
 from test.test_support import check_warnings
 
 from services.util import (function_moved, bigint2time, time2bigint,
                            batch, validate_password, ssha,
                            ssha256, valid_password, get_source_ip,
-                           CatchErrorMiddleware, round_time)
-from services.exceptions import BackendError
+                           CatchErrorMiddleware, round_time, CircuitBreaker,
+                           request_deadline, clamp_timeout,
+                           get_time_remaining, Timestamp,
+                           randstring, randchar, ErrorLog)
+from services import events, jsoncodec
+from services.events import APP_ENDS
+from services.exceptions import (BackendError, BackendTimeoutError,
+                                 CircuitOpenError)
 from services.tests.support import initenv, cleanupenv
 
 
@@ -188,6 +198,66 @@ class TestUtil(unittest.TestCase):
         self.assertTrue(valid_password(u'tarek', u't' * 8))
         self.assertFalse(valid_password(u'café' * 3, u'café' * 3))
 
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('test', min_calls=4, failure_rate=0.5,
+                                 cooldown=0.2)
+
+        # a few failures are not enough to open the breaker
+        breaker.record_success()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.allow()
+
+        # but a high failure rate is
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+
+        # after the cooldown, a single trial call is allowed
+        time.sleep(0.2)
+        breaker.allow()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertRaises(CircuitOpenError, breaker.allow)
+
+        # a failed trial re-opens it, a successful one closes it
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        time.sleep(0.2)
+        with breaker.guard():
+            pass
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+        # guard() records BackendErrors as failures
+        for i in range(4):
+            try:
+                with breaker.guard():
+                    raise BackendError()
+            except BackendError:
+                pass
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_request_deadline(self):
+        # no deadline, timeouts are left untouched
+        self.assertEqual(get_time_remaining(), None)
+        self.assertEqual(clamp_timeout(5), 5)
+        self.assertEqual(clamp_timeout(-1), -1)
+
+        with request_deadline(1):
+            self.assertTrue(clamp_timeout(5) <= 1)
+            self.assertTrue(0 < clamp_timeout(-1) <= 1)
+            self.assertEqual(clamp_timeout(0.5), 0.5)
+
+            # nested deadlines can only be shorter
+            with request_deadline(10):
+                self.assertTrue(get_time_remaining() <= 1)
+            with request_deadline(0):
+                time.sleep(0.01)
+                self.assertRaises(BackendTimeoutError, clamp_timeout, 5)
+            self.assertTrue(0 < get_time_remaining() <= 1)
+
+        self.assertEqual(get_time_remaining(), None)
+
     def test_get_source_ip(self):
         environ = {'HTTP_X_FORWARDED_FOR': 'one'}
         environ2 = {'REMOTE_ADDR': 'two'}
@@ -264,6 +334,96 @@ class TestUtil(unittest.TestCase):
         self.assertTrue(
             result[0].startswith('"application error: crash id'))
 
+    def test_middleware_error_storm(self):
+
+        class BadClass(object):
+            def __call__(self, environ, start_response):
+                raise Exception(environ['PATH_INFO'])
+
+        def fake_start_response(*args):
+            pass
+
+        app = CatchErrorMiddleware(BadClass())
+        errs = []
+        app.logger.error = errs.append
+
+        # identical errors are logged once, with unique crash ids
+        crash_ids = set()
+        for i in range(5):
+            result = app({'PATH_INFO': '/%d' % i}, fake_start_response)
+            crash_ids.add(result[0])
+        self.assertEqual(len(crash_ids), 5)
+        self.assertEqual(len(errs), 2)
+        self.assertTrue("'/0'" in errs[1])
+
+        # the suppressed ones are counted, at the latest when the app ends
+        self.assertTrue(app.error_log.flush in events._events[APP_ENDS])
+        app.error_log.flush()
+        self.assertEqual(len(errs), 3)
+        self.assertTrue(errs[2].startswith('4 more errors like crash id %s'
+                                           % errs[0]))
+
+        # the window can be disabled
+        app = CatchErrorMiddleware(BadClass(), error_window=0)
+        del errs[:]
+        for i in range(3):
+            app({'PATH_INFO': '/'}, fake_start_response)
+        self.assertEqual(len(errs), 6)
+
+    def test_error_log(self):
+        error_log = ErrorLog(window=60, max_signatures=2)
+        errs = []
+        debugs = []
+
+        class Logger(object):
+            error = errs.append
+            debug = debugs.append
+
+        logger = Logger()
+
+        def _format():
+            return 'full error'
+
+        error_log.log(logger, 'sig1', 'id1', _format)
+        error_log.log(logger, 'sig1', 'id2', _format)
+        error_log.log(logger, 'sig2', 'id3', _format)
+        self.assertEqual(errs, ['id1', 'full error', 'id3', 'full error'])
+        self.assertEqual(debugs, ['crash id id2 is like crash id id1'])
+
+        # too many signatures: the expired ones are dropped
+        error_log._errors['sig1'][1] -= 60
+        del errs[:]
+        error_log.log(logger, 'sig3', 'id4', _format)
+        self.assertEqual(errs[0][:37], '1 more errors like crash id id1 in th')
+        self.assertEqual(errs[1:], ['id4', 'full error'])
+        self.assertEqual(sorted(error_log._errors), ['sig2', 'sig3'])
+
+        # once the window is over, the error is logged again
+        error_log._errors['sig2'][1] -= 60
+        del errs[:]
+        error_log.log(logger, 'sig2', 'id5', _format)
+        self.assertEqual(errs, ['id5', 'full error'])
+
+        # the counts of the errors that stopped are logged with the next
+        # error, once per window
+        error_log.log(logger, 'sig2', 'id6', _format)
+        error_log._errors['sig2'][1] -= 60
+        error_log._next_sweep -= 60
+        del errs[:]
+        error_log.log(logger, 'sig4', 'id7', _format)
+        self.assertTrue(errs[0].startswith('1 more errors like crash id id5'))
+        self.assertEqual(errs[1:], ['id7', 'full error'])
+        self.assertFalse('sig2' in error_log._errors)
+
+        # when no signature expired, the oldest one is dropped
+        error_log.log(logger, 'sig3', 'id8', _format)
+        error_log._errors['sig3'][1] -= 1
+        del errs[:]
+        error_log.log(logger, 'sig5', 'id9', _format)
+        self.assertTrue(errs[0].startswith('1 more errors like crash id id4'))
+        self.assertEqual(errs[1:], ['id9', 'full error'])
+        self.assertEqual(sorted(error_log._errors), ['sig4', 'sig5'])
+
     def test_round_time(self):
 
         # returns a two-digits decimal of the current time
@@ -286,6 +446,60 @@ class TestUtil(unittest.TestCase):
         res = round_time(129084.198271987, precision=3)
         self.assertEqual(str(res), '129084.198')
 
+    def test_randstring(self):
+        calls = []
+        old_urandom = os.urandom
+
+        def _urandom(size):
+            calls.append(size)
+            return old_urandom(size)
+
+        os.urandom = _urandom
+        try:
+            res = randstring(16, 'ABC')
+        finally:
+            os.urandom = old_urandom
+        self.assertEqual(len(res), 16)
+        self.assertEqual(set(res) - set('ABC'), set())
+        # rejected bytes may need another read, but very rarely
+        self.assertTrue(len(calls) <= 2)
+
+        # no char is favored
+        counts = dict.fromkeys('ABC', 0)
+        for char in randstring(30000, 'ABC'):
+            counts[char] += 1
+        for count in counts.values():
+            self.assertTrue(9000 < count < 11000, counts)
+
+        self.assertEqual(randstring(0), '')
+        self.assertEqual(len(randstring(8, map(chr, range(256)))), 8)
+        self.assertRaises(ValueError, randstring, 8, range(257))
+        self.assertRaises(ValueError, randstring, 8, '')
+        self.assertEqual(len(randchar()), 1)
+
+    def test_timestamp(self):
+        # timestamps are drop-in replacements for two-digits Decimals
+        for value in (129084.198271987, '1297417122.1', 1.015, '-1.555',
+                      '.5', 0):
+            res = round_time(value)
+            expected = Decimal(str(value)).quantize(Decimal('1.00'))
+            self.assertTrue(isinstance(res, Timestamp))
+            self.assertEqual(res, expected)
+            self.assertEqual(str(res), str(expected))
+            self.assertEqual(hash(res), hash(expected))
+
+        res = round_time(1297417122.18)
+        self.assertEqual(res.units, 129741712218)
+        self.assertEqual(time2bigint(res), 129741712218)
+        self.assertEqual(bigint2time(129741712218), res)
+        self.assertEqual(str(bigint2time(5)), '0.05')
+        self.assertEqual(str(bigint2time(5, precision=3)), '0.050')
+        self.assertEqual(res + 1, Decimal('1297417123.18'))
+        self.assertEqual(float(res), 1297417122.18)
+        self.assertEqual(jsoncodec.dumps([res]), '[1297417122.18]')
+        self.assertTrue(copy.deepcopy(res) is res)
+        self.assertEqual(pickle.loads(pickle.dumps(res)), res)
+
     def test_request(self):
 
         class BackEndFails(object):
@@ -78,6 +78,72 @@ class User(dict):
         self['userid'] = userid
 
 
+class LazyUser(User):
+    """A user object bound to its backend.
+
+    Reading a missing attribute with user[key] fetches it from the backend,
+    along with the attributes passed to prefetch(), so that the attributes
+    a request needs can come in a single backend query.  Attributes
+    already in the user, such as the ones loaded by authenticate_user,
+    are never fetched again.  Attributes the backend doesn't know raise a
+    KeyError, like any missing key.
+
+    get() and "in" don't query the backend, so that backends can inspect
+    the user freely.
+
+    SyncServerApp prefetches the attributes listed in the "user_attrs"
+    extra of the route, e.g. {'user_attrs': ['mail', 'syncNode']}.  The
+    attributes of the routes that don't list them are fetched one by one.
+    """
+
+    def __init__(self, backend, username=None, userid=None):
+        super(LazyUser, self).__init__(username, userid)
+        self._backend = backend
+        self._wanted = set()
+        self._fetched = set()
+
+    def prefetch(self, *attrs):
+        """Fetches the attributes with the next missing one."""
+        self._wanted.update(attrs)
+
+    def __missing__(self, key):
+        if key in self._fetched:
+            raise KeyError(key)
+        attrs = [attr for attr in self._wanted | set([key])
+                 if attr not in self and attr not in self._fetched]
+        try:
+            self._fetch(attrs)
+        except (AttributeError, KeyError):
+            # an unknown attribute, maybe one of the prefetched ones
+            if len(attrs) == 1:
+                self._fetched.add(key)
+                raise KeyError(key)
+            return self[key]
+        return dict.__getitem__(self, key)
+
+    def _fetch(self, attrs):
+        # the backend works on a plain copy
+        user = User()
+        user.update(self)
+        try:
+            self._backend.get_user_info(user, attrs)
+        except (AttributeError, KeyError):
+            # the batch is not tried again
+            self._wanted.difference_update(attrs)
+            raise
+        self.update(user)
+        self._fetched.update(attrs)
+
+
+def make_user(backend, username=None, userid=None):
+    """Returns a LazyUser bound to the backend if it's a user backend, a
+    plain User otherwise."""
+    if backend is None or hasattr(backend, 'generate_reset_code'):
+        # no backend, or an old-style one
+        return User(username, userid)
+    return LazyUser(backend, username, userid)
+
+
 class ServicesUser(PluginRegistry):
     """Abstract Base Class for the authentication APIs.
 
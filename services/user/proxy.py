@@ -45,10 +45,11 @@ consideration of the tradeoffs.
 
 """
 
-import json
 
+from services import jsoncodec
 from services.http_helpers import get_url
 from services.exceptions import BackendError
+from services.health import register_backend
 
 from services.user import _password_to_credentials
 
@@ -68,6 +69,16 @@ class ProxyUser(object):
 
     def __init__(self, whoami_uri, **kw):
         self.whoami_uri = whoami_uri.rstrip("/")
+        register_backend(self.whoami_uri, self.check_health)
+
+    def check_health(self):
+        """Checks that the whoami API is answering.
+
+        The call is made without credentials, so a 401 is a good answer.
+        """
+        code, headers, body = get_url(self.whoami_uri, "GET")
+        if code >= 500:
+            raise BackendError("whoami API returned %d" % code)
 
     @_password_to_credentials
     def authenticate_user(self, user, credentials, attrs=None):
@@ -92,7 +103,7 @@ class ProxyUser(object):
             raise BackendError("whoami API unexpected behaviour")
 
         try:
-            user_data = json.loads(body)
+            user_data = jsoncodec.loads(body)
         except ValueError:
             logger = CLIENT_HOLDER.default_client
             logger.error("whoami API produced invalid JSON")
@@ -63,19 +63,28 @@ this deployment but deserve to be called out explicitly:
       You'll have to wait for the cache timeout to expire before the node
       starts giving 401s to unassigned users.
 
+    * If the whoami API is failing, credentials that were previously
+      verified will continue to be accepted for up to "stale_grace" seconds
+      after their cache entry has expired.  Set it to zero to disable this.
+
 """
 
 import os
 import time
-import json
 import hmac
 import Queue
+import random
 import hashlib
+import threading
 import contextlib
 
-from services.user import _password_to_credentials
+from services import jsoncodec
+from services.user import User, _password_to_credentials
 from services.user.proxy import ProxyUser
 from services.exceptions import BackendError
+from services.health import register_backend
+from services.events import subscribe, unsubscribe, APP_ENDS
+from services.metrics import backend_timer
 
 from metlog.holder import CLIENT_HOLDER
 from metlog.decorators.stats import timeit as metlog_timeit
@@ -112,11 +121,22 @@ class ProxyCacheUser(object):
               * knowing roughly the time at which the keys were written
               * brute-forcing HMAC-SHA256
 
+        * Each cache entry records when it should be refreshed and when it
+          expires.  Once the refresh time has passed, the entry is still
+          served but a background refresh is triggered against the whoami
+          API.  The refresh time is randomly jittered so that entries written
+          together do not all expire together.
+
+        * Entries are kept in memcached for "stale_grace" seconds past their
+          expiry time.  An expired entry is never used while whoami is
+          working, but it will be served if whoami raises a BackendError.
 
     """
 
     def __init__(self, whoami_uri, secret_key=None, cache_servers=None,
-                 cache_prefix="ProxyCacheUser/", cache_timeout=60*60, **kw):
+                 cache_prefix="ProxyCacheUser/", cache_timeout=60*60,
+                 refresh_ratio=0.8, refresh_jitter=0.1, stale_grace=10*60,
+                 **kw):
         self.proxy = ProxyUser(whoami_uri)
         # Use a randomly-generated secret key if none is specified.
         # This is secure, but will reduce the re-usability of the cache.
@@ -132,8 +152,17 @@ class ProxyCacheUser(object):
             cache_servers = ['127.0.0.1:11211']
         self.cache_prefix = cache_prefix
         self.cache_timeout = int(cache_timeout)
+        self.refresh_ratio = float(refresh_ratio)
+        self.refresh_jitter = float(refresh_jitter)
+        self.stale_grace = int(stale_grace)
         self.cache_client = pylibmc.Client(cache_servers)
         self.cache_pool = BottomlessClientPool(self.cache_client)
+        register_backend("memcache:" + ",".join(cache_servers),
+                         self.check_health)
+        subscribe(APP_ENDS, self.cache_pool.close, weak=True)
+        # Tokens for which a background refresh is currently running.
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
 
     @_password_to_credentials
     def authenticate_user(self, user, credentials, attrs=None):
@@ -143,6 +172,8 @@ class ProxyCacheUser(object):
         password = credentials.get("password")
         if not password:
             return None
+        if attrs is None:
+            attrs = []
 
         # The auth caching token includes a timestamp-derived counter, so
         # there are several possibile tokens that could be active in the cache.
@@ -150,49 +181,121 @@ class ProxyCacheUser(object):
 
         # Look for all of those tokens in the cache with a single get.
         # If any one of them exists, the auth is OK.
+        stale_user_data = None
         cached_user_data = self._cache_get(*tokens)
         if cached_user_data is not None:
-            user.update(cached_user_data)
+            now = time.time()
+            refresh_at = cached_user_data.pop("_refresh_at", None)
+            expires_at = cached_user_data.pop("_expires_at", None)
             # Check that we got all the requested attributes.
             # If not, we'll have to fall back to the proxy API to fetch them.
             for attr in attrs:
-                if attr not in user:
+                if attr not in cached_user_data:
                     break
             else:
-                CLIENT_HOLDER.default_client.incr(METLOG_PREFIX + "cache_hit")
-                return user["userid"]
+                if expires_at is None or now < expires_at:
+                    user.update(cached_user_data)
+                    if refresh_at is not None and now >= refresh_at:
+                        self._start_refresh(tokens, username,
+                                            credentials, attrs)
+                    CLIENT_HOLDER.default_client.incr(METLOG_PREFIX +
+                                                      "cache_hit")
+                    return user["userid"]
+                # Expired, but usable if the proxy is failing.
+                stale_user_data = cached_user_data
 
         # Not cached, call through to the proxy.
-        userid = self.proxy.authenticate_user(user, credentials, attrs)
+        try:
+            userid = self.proxy.authenticate_user(user, credentials, attrs)
+        except BackendError:
+            if stale_user_data is None:
+                raise
+            CLIENT_HOLDER.default_client.incr(METLOG_PREFIX + "cache_stale")
+            user.update(stale_user_data)
+            return user["userid"]
         if userid is None:
             return None
         CLIENT_HOLDER.default_client.incr(METLOG_PREFIX + "cache_miss")
 
         # Now we know the account is good, write it into the cache
         # using the most recent token as key.
-        cached_user_data = {"userid": userid}
-        if attrs:
-            for attr in attrs:
-                cached_user_data[attr] = user[attr]
-        self._cache_set(tokens[0], cached_user_data)
-
+        self._store_user_data(tokens[0], user, attrs)
         return userid
 
+    def _store_user_data(self, token, user, attrs):
+        """Write freshly-verified user data into the cache under a token."""
+        now = time.time()
+        jitter = 1 - random.uniform(0, self.refresh_jitter)
+        refresh_after = self.cache_timeout * self.refresh_ratio * jitter
+        cached_user_data = {"userid": user["userid"],
+                            "_refresh_at": now + refresh_after,
+                            "_expires_at": now + self.cache_timeout}
+        for attr in attrs:
+            cached_user_data[attr] = user[attr]
+        self._cache_set(token, cached_user_data)
+
+    def _start_refresh(self, tokens, username, credentials, attrs):
+        """Refresh a cache entry from the proxy in the background.
+
+        `tokens` are all the possible tokens of the credentials, the entry
+        may have been found under any of them.  At most one refresh is run
+        for any given credentials.  Under gevent this thread will be a
+        greenlet, so it's cheap to spawn.
+        """
+        with self._refreshing_lock:
+            if tokens[0] in self._refreshing:
+                return
+            self._refreshing.add(tokens[0])
+        refresher = threading.Thread(target=self._refresh,
+                                     args=(tokens, username, credentials,
+                                           list(attrs)))
+        refresher.daemon = True
+        refresher.start()
+
+    def _refresh(self, tokens, username, credentials, attrs):
+        """Re-authenticate against the proxy and re-write the cache entry.
+
+        The entry is written under the most recent token.  If the
+        credentials are no longer valid then the entries of all the tokens
+        are dropped, so that the next request will have to go through the
+        proxy.
+        """
+        logger = CLIENT_HOLDER.default_client
+        try:
+            user = User(username)
+            userid = self.proxy.authenticate_user(user, credentials, attrs)
+            if userid is None:
+                for token in tokens:
+                    self._cache_delete(token)
+            else:
+                self._store_user_data(tokens[0], user, attrs)
+                logger.incr(METLOG_PREFIX + "cache_refresh")
+        except Exception, err:
+            logger.error("background refresh failed: %s" % (err,))
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(tokens[0])
+
+    def check_health(self):
+        """Checks that memcached is answering."""
+        self._cache_get("__heartbeat__")
+
     def _generate_possible_tokens(self, username, password):
         """Generate possible auth-caching tokens for these credentials.
 
         The token is a HMAC of the username, the password, and a "counter"
         derived from the current timestamp.  The counter is used to add a
         little bit of perturbation into what's otherwise a deterministic
-        hash.  It is the number of cache_timeout intervals that have elapsed
-        since the unix epoch, i.e. counter = floor(cur_time / cache_timeout).
+        hash.  It is the number of cache lifetime intervals that have elapsed
+        since the unix epoch, i.e. counter = floor(cur_time / cache_ttl)
+        where cache_ttl = cache_timeout + stale_grace.
 
         We allow both the current counter value and the previous one when
         when checking for valid cached credentials.  The TTLs in memcache
         will ensure that we're not using old data once it has expired.
         """
         template = "%s:%s:%d"
-        counter = int(time.time() / self.cache_timeout)
+        counter = int(time.time() / self._cache_ttl())
         hasher = self.hmac_master.copy()
         hasher.update(template % (username, password, counter))
         yield hasher.digest().encode('base64').strip()
@@ -216,7 +319,7 @@ class ProxyCacheUser(object):
                 raise BackendError(str(err))
             for key in keys:
                 if key in values:
-                    return json.loads(values[key])
+                    return jsoncodec.loads(values[key])
             return None
 
     @metlog_timeit
@@ -225,11 +328,25 @@ class ProxyCacheUser(object):
         key = self.cache_prefix + key
         with self.cache_pool.reserve() as mc:
             try:
-                if not mc.set(key, json.dumps(value), self.cache_timeout):
+                if not mc.set(key, jsoncodec.dumps(value), self._cache_ttl()):
                     raise BackendError('memcached error')
             except pylibmc.Error, err:
                 raise BackendError(str(err))
 
+    @metlog_timeit
+    def _cache_delete(self, key):
+        """Remove an item from the cache."""
+        key = self.cache_prefix + key
+        with self.cache_pool.reserve() as mc:
+            try:
+                mc.delete(key)
+            except pylibmc.Error, err:
+                raise BackendError(str(err))
+
+    def _cache_ttl(self):
+        """The time for which entries are kept in memcache."""
+        return self.cache_timeout + self.stale_grace
+
     # All other methods are disabled on the proxy.
     # Only authenticate_user() is allowed.
 
@@ -273,6 +390,17 @@ class BottomlessClientPool(pylibmc.ClientPool):
         self._mc = mc
         pylibmc.ClientPool.__init__(self, mc, n_slots)
 
+    def close(self):
+        """Disconnects all the clients of the pool."""
+        unsubscribe(APP_ENDS, self.close)
+        while True:
+            try:
+                mc = self.get(False)
+            except Queue.Empty:
+                break
+            mc.disconnect_all()
+        self._mc.disconnect_all()
+
     @contextlib.contextmanager
     def reserve(self):
         try:
@@ -280,6 +408,7 @@ class BottomlessClientPool(pylibmc.ClientPool):
         except Queue.Empty:
             mc = self._mc.clone()
         try:
-            yield mc
+            with backend_timer("memcache"):
+                yield mc
         finally:
             self.put(mc)
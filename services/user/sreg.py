@@ -36,9 +36,9 @@
 # ***** END LICENSE BLOCK *****
 """ Mozilla Authentication using a two-tier system
 """
-import simplejson as json
 import urlparse
 
+from services import jsoncodec
 from services.http_helpers import get_url
 from services.user.mozilla_ldap import LDAPUser
 from services.user import User, _password_to_credentials
@@ -154,13 +154,13 @@ class SregUser(LDAPUser):
         - netloc: proxy location
         """
         if data is not None:
-            data = json.dumps(data)
+            data = jsoncodec.dumps(data)
 
         status, headers, body = get_url(url, method, data, headers)
 
         if body:
             try:
-                body = json.loads(body)
+                body = jsoncodec.loads(body)
             except Exception:
                 self.logger.error("bad json body from sreg (%s): %s" %
                                                         (url, body))
@@ -43,13 +43,16 @@ import random
 import string
 from hashlib import sha256, sha1, md5
 import base64
-import simplejson as json
 import itertools
 import re
 import datetime
 import os
 import urllib2
+from collections import deque
+from contextlib import contextmanager
 from decimal import Decimal, InvalidOperation
+import math
+import threading
 import time
 import warnings
 
@@ -62,7 +65,13 @@ import sqlalchemy
 from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
 
 from metlog.holder import CLIENT_HOLDER
-from services.exceptions import BackendError, BackendTimeoutError  # NOQA
+from services import jsoncodec
+from services.exceptions import (BackendError, BackendTimeoutError,  # NOQA
+                                 CircuitOpenError)
+from services.health import register_backend
+from services.events import subscribe, APP_ENDS
+from services.context import request_context, get_context_value
+from services.metrics import backend_timer
 
 random.seed()
 _RE_CODE = re.compile('[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}')
@@ -91,23 +100,92 @@ def function_moved(moved_to, follow_redirect=True):
     return arg_wrapper
 
 
+def randstring(length, chars=string.digits + string.letters):
+    """Generates a random string of *length* chars using urandom.
+
+    All the random bytes are read with a single urandom call. Bytes that
+    would favor the first chars of *chars* are rejected, so each char is
+    picked with the same probability, so *chars* can't have more than
+    256 chars.
+
+    If the system does not support urandom, the function fallbacks on
+    random.choice
+    """
+    size = len(chars)
+    if not 0 < size <= 256:
+        raise ValueError('chars must have between 1 and 256 chars')
+    limit = 256 - 256 % size
+    res = []
+    try:
+        while len(res) < length:
+            missing = length - len(res)
+            # draw a few extra bytes to make up for the rejected ones
+            for byte in os.urandom(missing + missing // 8 + 2):
+                pos = ord(byte)
+                if pos < limit:
+                    res.append(chars[pos % size])
+                    if len(res) == length:
+                        break
+    except NotImplementedError:
+        return ''.join([random.choice(chars) for i in range(length)])
+    return ''.join(res)
+
+
 def randchar(chars=string.digits + string.letters):
     """Generates a random char using urandom.
 
     If the system does not support it, the function fallbacks on random.choice
+    """
+    return randstring(1, chars)
 
-    See Haypo's explanation on the used formula to pick a char:
-    http://bitbucket.org/haypo/hasard/src/tip/doc/common_errors.rst
+
+class Timestamp(Decimal):
+    """A Decimal timestamp built from an integer number of centiseconds.
+
+    Instances behave like the Decimal they represent (comparisons,
+    arithmetic, quantize...) but are built without parsing nor rounding,
+    and their string form is computed once with integer formatting.
+
+    Args:
+        units: the timestamp as an integer, in 10 ** -precision seconds.
+        precision: number of digits. defaults to 2, i.e. centiseconds.
     """
-    try:
-        pos = int(float(ord(os.urandom(1))) * 256. / 255.)
-        return chars[pos % len(chars)]
-    except NotImplementedError:
-        return random.choice(chars)
+    __slots__ = ('units', '_str')
+
+    def __new__(cls, units, precision=2):
+        self = object.__new__(cls)
+        self.units = units
+        self._sign = int(units < 0)
+        self._int = str(abs(units))
+        self._exp = -precision
+        self._is_special = False
+        if precision > 0:
+            whole, frac = divmod(abs(units), 10 ** precision)
+            self._str = '%s%d.%0*d' % (self._sign and '-' or '', whole,
+                                       precision, frac)
+        else:
+            self._str = Decimal.__str__(self)
+        return self
+
+    def __str__(self, eng=False, context=None):
+        if eng or context is not None:
+            return Decimal.__str__(self, eng, context)
+        return self._str
+
+    def __reduce__(self):
+        return (self.__class__, (self.units, -self._exp))
+
+    def __copy__(self):
+        return self     # immutable, like Decimal
+
+    def __deepcopy__(self, memo):
+        return self
 
 
 def time2bigint(value):
     """Encodes a float timestamp into a big int"""
+    if isinstance(value, Timestamp) and value._exp == -2:
+        return value.units
     return int(value * 100)
 
 
@@ -118,6 +196,8 @@ def bigint2time(value, precision=2):
     """
     if value is None:   # unexistant
         return None
+    if isinstance(value, (int, long)) and precision >= 2:
+        return Timestamp(value * 10 ** (precision - 2), precision)
     res = Decimal(value) / 100
     digits = '0' * precision
     return res.quantize(Decimal('1.' + digits))
@@ -139,11 +219,22 @@ def round_time(value=None, precision=2):
         value = time.time()
     if not isinstance(value, str):
         value = str(value)
+
+    # str() of a current float timestamp has at most two digits, so in
+    # most cases no rounding is needed and the digits are used as is
+    whole, __, frac = value.partition('.')
+    if (len(frac) <= precision and whole.isdigit()
+            and (frac.isdigit() or frac == '')):
+        return Timestamp(int(whole + frac.ljust(precision, '0')), precision)
+
     try:
         digits = '0' * precision
-        return Decimal(value).quantize(Decimal('1.' + digits))
+        res = Decimal(value).quantize(Decimal('1.' + digits))
     except InvalidOperation:
         raise ValueError(value)
+    if not res.is_finite():
+        return res
+    return Timestamp(int(res.scaleb(precision)), precision)
 
 
 _SALT_LEN = 8
@@ -151,7 +242,7 @@ _SALT_LEN = 8
 
 def _gensalt():
     """Generates a salt"""
-    return ''.join([randchar() for i in range(_SALT_LEN)])
+    return randstring(_SALT_LEN)
 
 
 def ssha(password, salt=None):
@@ -220,7 +311,8 @@ def validate_password(clear, hash):
     salt = base64.decodestring(real_hash)[-_SALT_LEN:]
 
     # both hash_meth take a unicode value for clear
-    password = hash_meth(clear, salt)
+    with backend_timer('password'):
+        password = hash_meth(clear, salt)
     return password == hash
 
 
@@ -269,7 +361,7 @@ class HTTPJsonBadRequest(HTTPBadRequest):
         headerlist = [(key, value) for key, value in
                       list(self.headerlist)
                       if key != 'Content-Type']
-        body = json.dumps(self.detail, use_decimal=True)
+        body = jsoncodec.dumps(self.detail)
         resp = Response(body,
             status=self.status,
             headerlist=headerlist,
@@ -286,7 +378,7 @@ class HTTPJsonServiceUnavailable(HTTPServiceUnavailable):
         if self.content_length is not None:
             del self.content_length
         self.headers['Content-Type'] = 'application/json'
-        body = json.dumps(self.detail, use_decimal=True)
+        body = jsoncodec.dumps(self.detail)
         resp = Response(body,
             status=self.status,
             headerlist=self.headers.items())
@@ -310,14 +402,110 @@ def email_to_idn(addr):
     return "%s@%s" % (prefix.encode('idna'), suffix.encode('idna'))
 
 
+def get_error_signature(exc_type, exc_tb):
+    """Returns a stable signature for an exception: its type and the
+    code locations of its traceback."""
+    frames = []
+    while exc_tb is not None:
+        code = exc_tb.tb_frame.f_code
+        frames.append((code.co_filename, code.co_name, exc_tb.tb_lineno))
+        exc_tb = exc_tb.tb_next
+    return (exc_type, tuple(frames))
+
+
+class ErrorLog(object):
+    """Logs errors, deduplicated by signature.
+
+    The first error of a given signature is logged in full, with its crash
+    id. The identical errors raised in the next *window* seconds are only
+    counted, and their count is logged along with the next full log of
+    that signature, or on flush().  Their crash ids are logged at the debug
+    level, along with the crash id of the full log.
+
+    Options:
+        - window: deduplication window, in seconds. 0 logs every error.
+        - max_signatures: number of signatures tracked.  When there are
+          that many, the expired ones are flushed, or else the oldest one.
+    """
+    def __init__(self, window=60, max_signatures=1000):
+        self.window = float(window)
+        self.max_signatures = int(max_signatures)
+        # signature -> [crash id, window start, suppressed count]
+        self._errors = {}
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+
+    def log(self, logger, signature, crash_id, format_error):
+        """Logs an error, unless an identical one was logged recently.
+
+        format_error is only called when the error is logged in full.
+        """
+        now = time.time()
+        with self._lock:
+            # the counts of the errors that stopped are logged along with
+            # the next error, whatever its signature
+            if now >= self._next_sweep:
+                self._flush(logger, now)
+                self._next_sweep = now + self.window
+            entry = self._errors.get(signature)
+            if entry is not None and now - entry[1] < self.window:
+                entry[2] += 1
+                logged_id = entry[0]
+            else:
+                logged_id = None
+                if entry is None and len(self._errors) >= self.max_signatures:
+                    self._flush(logger, now)
+                    if len(self._errors) >= self.max_signatures:
+                        self._evict(logger, now)
+                self._errors[signature] = [crash_id, now, 0]
+
+        if logged_id is not None:
+            # so that the crash id reported by a user can be looked up
+            logger.debug('crash id %s is like crash id %s'
+                         % (crash_id, logged_id))
+            return
+        if entry is not None and entry[2] > 0:
+            self._log_suppressed(logger, entry, now)
+        logger.error(crash_id)
+        logger.error(format_error())
+
+    def flush(self, logger=None):
+        """Logs the counts of all the suppressed errors."""
+        if logger is None:
+            logger = CLIENT_HOLDER.default_client
+        with self._lock:
+            self._flush(logger, None)
+
+    def _flush(self, logger, now):
+        # drops the entries whose window is over, or all of them
+        for signature, entry in self._errors.items():
+            if now is None or now - entry[1] >= self.window:
+                del self._errors[signature]
+                if entry[2] > 0:
+                    self._log_suppressed(logger, entry, now or time.time())
+
+    def _evict(self, logger, now):
+        # drops the entry with the oldest window
+        signature = min(self._errors, key=lambda sig: self._errors[sig][1])
+        entry = self._errors.pop(signature)
+        if entry[2] > 0:
+            self._log_suppressed(logger, entry, now)
+
+    def _log_suppressed(self, logger, entry, now):
+        logger.error('%d more errors like crash id %s in the last %ds'
+                     % (entry[2], entry[0], now - entry[1]))
+
+
 class CatchErrorMiddleware(object):
     """Middleware that catches error, log them and return a 500"""
     def __init__(self, app, logger_name='root', hook=None,
-                 type='application/json'):
+                 type='application/json', error_window=60):
         self.app = app
         self.logger = CLIENT_HOLDER.default_client
         self.hook = hook
         self.ctype = type
+        self.error_log = ErrorLog(error_window)
+        subscribe(APP_ENDS, self.error_log.flush, weak=True)
 
     def __call__(self, environ, start_response):
         try:
@@ -329,23 +517,33 @@ class CatchErrorMiddleware(object):
             # Format the traceback using standard printing, but use repr()
             # on the exception value itself to avoid this issue.
             exc_type, exc_val, exc_tb = sys.exc_info()
-            lines = ["Uncaught exception while processing request:\n"]
-            req_method = environ.get("REQUEST_METHOD", "")
-            req_path = environ.get("SCRIPT_NAME", "")
-            req_path += environ.get("PATH_INFO", "")
-            lines.append("%s %s\n" % (req_method, req_path))
-            lines.extend(traceback.format_tb(exc_tb))
-            lines.append("%r\n" % (exc_type,))
-            lines.append("%r\n" % (exc_val,))
-            err = "".join(lines)
-            # Log it, then send a crash id back to the client.
-            hash = create_hash(err)
-            self.logger.error(hash)
-            self.logger.error(err)
+
+            def _format_error():
+                lines = ["Uncaught exception while processing request:\n"]
+                req_method = environ.get("REQUEST_METHOD", "")
+                req_path = environ.get("SCRIPT_NAME", "")
+                req_path += environ.get("PATH_INFO", "")
+                lines.append("%s %s\n" % (req_method, req_path))
+                lines.extend(traceback.format_tb(exc_tb))
+                lines.append("%r\n" % (exc_type,))
+                lines.append("%r\n" % (exc_val,))
+                return "".join(lines)
+
+            # Log it, unless it was just logged, then send a unique crash id
+            # back to the client.
+            signature = get_error_signature(exc_type, exc_tb)
+            hash = create_hash(repr(signature))
+            if self.hook:
+                err = _format_error()
+                self.error_log.log(self.logger, signature, hash, lambda: err)
+            else:
+                self.error_log.log(self.logger, signature, hash,
+                                   _format_error)
             start_response('500 Internal Server Error',
                            [('content-type', self.ctype)])
 
-            response = json.dumps("application error: crash id %s" % hash)
+            response = jsoncodec.dumps("application error: crash id %s"
+                                       % hash)
             if self.hook:
                 try:
                     response = self.hook({'error': err, 'crash_id': hash,
@@ -362,19 +560,234 @@ class CatchErrorMiddleware(object):
             return [response]
 
 
+@contextmanager
+def request_deadline(timeout):
+    """Context manager that sets a deadline for the work done in the block.
+
+    Backend calls made within the block consult the deadline through
+    clamp_timeout() so that they never outlive the request.  Nested
+    deadlines can only make the deadline shorter.  If timeout is None, no
+    deadline is set.
+    """
+    if timeout is None:
+        yield
+        return
+    old_deadline = get_context_value('deadline')
+    deadline = time.time() + timeout
+    if old_deadline is not None and old_deadline < deadline:
+        deadline = old_deadline
+    with request_context(deadline=deadline):
+        yield
+
+
+def get_time_remaining():
+    """Returns the seconds left before the current deadline, or None."""
+    deadline = get_context_value('deadline')
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def clamp_timeout(timeout):
+    """Shrinks a backend timeout so that it fits in the current deadline.
+
+    A timeout of None or a negative one means "no timeout".  If the
+    deadline has already passed a BackendTimeoutError is raised, so that
+    doomed work is not even started.
+    """
+    remaining = get_time_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise BackendTimeoutError('Request deadline exceeded')
+    if timeout is None or timeout < 0 or timeout > remaining:
+        return remaining
+    return timeout
+
+
+class CircuitBreaker(object):
+    """Tracks the health of a remote backend and fails fast when it is down.
+
+    The breaker is "closed" while the backend works.  Outcomes of the calls
+    made in the last `window` seconds are kept, and once at least
+    `min_calls` of them were made with a failure rate of `failure_rate` or
+    more, the breaker "opens".  While open, allow() raises a
+    CircuitOpenError straight away, with a retry_after set to the remaining
+    cooldown.
+
+    After `cooldown` seconds the breaker is "half-open": a single trial call
+    is let through, and its outcome decides whether the breaker closes again
+    or re-opens for another cooldown.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=10, min_calls=20, failure_rate=0.5,
+                 cooldown=30, max_calls=1000):
+        self.name = name
+        self.window = float(window)
+        self.min_calls = int(min_calls)
+        self.failure_rate = float(failure_rate)
+        self.cooldown = float(cooldown)
+        self.state = self.CLOSED
+        self._calls = deque(maxlen=int(max_calls))
+        self._opened_at = None
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'Circuit breaker %r (%s)' % (self.name, self.state)
+
+    def allow(self):
+        """Raises a CircuitOpenError if the backend should not be called."""
+        if self.state == self.CLOSED:
+            return
+        with self._lock:
+            now = time.time()
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.cooldown - now
+                if remaining > 0:
+                    self._fail_fast(remaining)
+                self.state = self.HALF_OPEN
+                self._trial_started_at = None
+            if self.state == self.HALF_OPEN:
+                # Only one trial call at a time.  A trial that never reported
+                # back is given up on after a cooldown.
+                if self._trial_started_at is not None:
+                    remaining = self._trial_started_at + self.cooldown - now
+                    if remaining > 0:
+                        self._fail_fast(remaining)
+                self._trial_started_at = now
+
+    def _fail_fast(self, remaining):
+        raise CircuitOpenError('Circuit breaker is open', server=self.name,
+                               retry_after=int(math.ceil(remaining)))
+
+    def record_success(self):
+        """Records a successful call to the backend."""
+        if self.state == self.CLOSED:
+            self._record(False)
+            return
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self._calls.clear()
+                self._trial_started_at = None
+
+    def record_failure(self):
+        """Records a failed call to the backend."""
+        if self.state == self.CLOSED:
+            self._record(True)
+            return
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._open()
+
+    def _record(self, failed):
+        now = time.time()
+        with self._lock:
+            calls = self._calls
+            calls.append((now, failed))
+            if not failed:
+                return
+            # forget about calls that went out of the window
+            while calls and calls[0][0] < now - self.window:
+                calls.popleft()
+            if len(calls) < self.min_calls:
+                return
+            failures = len([1 for __, failed_ in calls if failed_])
+            if float(failures) / len(calls) >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._trial_started_at = None
+        self._calls.clear()
+        logger = CLIENT_HOLDER.default_client
+        if logger is not None:
+            logger.error('%s opened for %ds' % (self.name, self.cooldown))
+
+    @contextmanager
+    def guard(self, failures=(BackendError,)):
+        """Context manager that protects a call to the backend.
+
+        Exceptions of the `failures` types are recorded as failures, and
+        anything else as a success.
+        """
+        self.allow()
+        try:
+            yield self
+        except failures:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        else:
+            self.record_success()
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+_BREAKER_DEFAULTS = {}
+
+
+def get_circuit_breaker(name):
+    """Returns the process-wide circuit breaker for a backend."""
+    try:
+        return _BREAKERS[name]
+    except KeyError:
+        with _BREAKERS_LOCK:
+            if name not in _BREAKERS:
+                _BREAKERS[name] = CircuitBreaker(name, **_BREAKER_DEFAULTS)
+            return _BREAKERS[name]
+
+
+def configure_circuit_breakers(**settings):
+    """Sets the options used for all circuit breakers.
+
+    Accepts the keyword arguments of CircuitBreaker.  Existing breakers are
+    dropped, so they will be re-created using the new settings.
+    """
+    with _BREAKERS_LOCK:
+        _BREAKER_DEFAULTS.clear()
+        _BREAKER_DEFAULTS.update(settings)
+        _BREAKERS.clear()
+
+
 def create_engine(*args, **kwds):
     """Wrapper for sqlalchemy.create_engine with some extra security measures.
 
     This function wraps a call to sqlalchemy.create_engine with logic to
     restrict the process umask.  This ensures that sqlite database files are
     created with secure permissions by default.
+
+    The database is also registered for the health checks, and its
+    connection pool is closed when the app ends.
     """
     old_umask = os.umask(0077)
     try:
-        return sqlalchemy.create_engine(*args, **kwds)
+        engine = sqlalchemy.create_engine(*args, **kwds)
     finally:
         os.umask(old_umask)
 
+    register_backend(_get_engine_name(engine), _check_engine_health, engine)
+    subscribe(APP_ENDS, engine.dispose, weak=True)
+    return engine
+
+
+def _check_engine_health(engine):
+    safe_execute(engine, 'SELECT 1').close()
+
+
+def _get_engine_name(engine):
+    """Returns a name for the database, without the credentials."""
+    url = engine.url
+    return 'sql:%s://%s/%s' % (url.drivername, url.host or '',
+                               url.database or '')
+
 
 def execute_with_cleanup(engine, query, *args, **kwargs):
     """Execution wrapper that kills queries on untimely exit.
@@ -443,24 +856,42 @@ def execute_with_cleanup(engine, query, *args, **kwargs):
 def safe_execute(engine, *args, **kwargs):
     """Execution wrapper that will raise a HTTPServiceUnavailableError
     on any OperationalError errors and log it.
+
+    Calls go through the circuit breaker of the database, so they fail fast
+    with a CircuitOpenError while it is down.  No query is started once the
+    request deadline has passed.
     """
+    clamp_timeout(None)
+    breaker = get_circuit_breaker(_get_engine_name(engine))
+    breaker.allow()
+    with backend_timer('sql'):
+        return _safe_execute(engine, breaker, *args, **kwargs)
+
+
+def _safe_execute(engine, breaker, *args, **kwargs):
     try:
         # It's possible for the backend to raise a "connection invalided" error
         # if e.g. the server timed out the connection.  SQLAlchemy purges the
         # the whole connection pool if this happens, so one retry is enough.
         try:
-            return execute_with_cleanup(engine, *args, **kwargs)
+            result = execute_with_cleanup(engine, *args, **kwargs)
         except DBAPIError, exc:
-            if _is_retryable_db_error(engine, exc):
+            remaining = get_time_remaining()
+            if (_is_retryable_db_error(engine, exc) and
+                (remaining is None or remaining > 0)):
                 logger = CLIENT_HOLDER.default_client
                 logger.incr('services.util.safe_execute.retry')
                 logger.debug('retrying due to db error %r', exc)
-                return execute_with_cleanup(engine, *args, **kwargs)
+                result = execute_with_cleanup(engine, *args, **kwargs)
             else:
                 raise
+        breaker.record_success()
+        return result
     except Exception, exc:
         if not _is_operational_db_error(engine, exc):
+            breaker.record_success()
             raise
+        breaker.record_failure()
         err = traceback.format_exc()
         logger = CLIENT_HOLDER.default_client
         logger.error(err)
@@ -538,7 +969,7 @@ def create_hash(data):
     """Creates a unique hash using the data provided
     and a bit of randomness
     """
-    rand = ''.join([randchar() for x in range(10)])
+    rand = randstring(10)
     data += rand
     return md5(data + rand).hexdigest()
 
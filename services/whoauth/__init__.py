@@ -52,7 +52,7 @@ from metlog.holder import CLIENT_HOLDER
 from metlog_cef import AUTH_FAILURE
 
 from services.pluginreg import load_and_configure
-from services.user import User
+from services.user import make_user
 
 from services.whoauth.backendauth import BackendAuthPlugin
 
@@ -166,7 +166,8 @@ class WhoAuthentication(object):
         match["user_id"] = identity["userid"]
         request.remote_user = identity["username"]
         request.environ["REMOTE_USER"] = identity["username"]
-        request.user = User(identity["username"], identity["userid"])
+        request.user = make_user(self.backend, identity["username"],
+                                 identity["userid"])
         request.user.update(identity)
 
     def acknowledge(self, request, response):
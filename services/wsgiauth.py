@@ -45,7 +45,7 @@ from metlog.holder import CLIENT_HOLDER
 from metlog_cef import AUTH_FAILURE
 
 from services.pluginreg import load_and_configure
-from services.user import User, extract_username
+from services.user import User, LazyUser, extract_username
 
 
 class Authentication(object):
@@ -184,7 +184,7 @@ class Authentication(object):
                                                              password)
                 request.user = User(user_name, user_id)
             else:
-                user = User(user_name)
+                user = LazyUser(self.backend, user_name)
                 credentials = {"username": user_name, "password": password}
                 attrs = []
                 check_node = self.config.get('auth.check_node')